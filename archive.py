@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Raw responses of the crawl, kept so that the dataset can be re-derived by
+# running the spider callbacks again without touching the network. Every
+# response is one gzip member (a json header line followed by the body)
+# appended to the archive, and the index next to it maps the offset and
+# length of every member to its url.
+
+import gzip
+import json
+import os
+import threading
+import time
+
+
+class ResponseArchive(object):
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock = threading.Lock()
+        self.archive_file = open(path, 'ab')
+        self.index_file = open(self.index_path, 'a')
+
+    def write(self, url, status, headers, body, callback):
+        header = {
+            'url': url,
+            'status': status,
+            'headers': headers,
+            'callback': callback,
+            'fetched_at': time.time(),
+        }
+        record = gzip.compress(json.dumps(header).encode('utf-8') + b'\n' + body)
+        with self.lock:
+            offset = self.archive_file.tell()
+            self.archive_file.write(record)
+            self.archive_file.flush()
+            self.index_file.write('{}\t{}\t{}\n'.format(offset, len(record), url))
+            self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.archive_file.close()
+            self.index_file.close()
+
+
+def read_index(path):
+    # the latest (offset, length) of every url in the archive, in the order
+    # the urls were first archived
+    entries = {}
+    if not os.path.isfile(path + '.idx'):
+        return entries
+    with open(path + '.idx') as index_file:
+        for line in index_file:
+            parts = line.rstrip('\n').split('\t', 2)
+            if len(parts) == 3:
+                entries[parts[2]] = (int(parts[0]), int(parts[1]))
+    return entries
+
+
+def read_records(path, entries):
+    # (header, body) of the (offset, length) entries
+    with open(path, 'rb') as archive_file:
+        for offset, length in entries:
+            archive_file.seek(offset)
+            header, body = gzip.decompress(archive_file.read(length)).split(b'\n', 1)
+            yield json.loads(header.decode('utf-8')), body
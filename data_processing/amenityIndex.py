@@ -0,0 +1,180 @@
+from bisect import bisect_left
+import json
+import numpy as np
+import re
+import zlib
+
+word_re = re.compile(r'[a-z0-9]+')
+query_token_re = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+
+
+def normalize_feature(feature):
+    return word_re.findall(str(feature).lower())
+
+
+def matches_phrase(feature_words, words):
+    # words in order within the feature, the last one as a prefix
+    for start in range(len(feature_words) - len(words) + 1):
+        if feature_words[start:start + len(words) - 1] == words[:-1] \
+                and feature_words[start + len(words) - 1].startswith(words[-1]):
+            return True
+    return False
+
+
+def feature_signature(feature_lists):
+    # crc of every feature of every listing in order, an index is reused
+    # while the signature of the feature lists it was built from matches
+    return zlib.crc32('\x1e'.join('\x1f'.join(features)
+        if features is not None and not isinstance(features, float) else ''
+        for features in feature_lists).encode('utf-8'))
+
+
+def to_bitset(mask):
+    return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+
+class AmenityIndex:
+    # inverted index from the words of every listing's feature_list to a
+    # bitset of listing positions, built in one pass over the features.
+    # A query word matches every indexed word it is a prefix of, so a bare
+    # "c" matches any word starting with c. A quoted term of several words
+    # is a phrase that must match within one feature, its words in order
+    # and the last one as a prefix: "air c" finds "Air Conditioning" but not
+    # "Fresh Air" next to "Carpet".
+    #
+    # Queries combine terms with AND, OR, NOT and parentheses, terms next to
+    # each other must all match: 'washer AND dishwasher AND NOT carpet'.
+    def __init__(self, feature_lists):
+        self.size = len(feature_lists)
+        self.signature = feature_signature(feature_lists)
+        # phrases are checked against the features themselves
+        self.feature_lists = feature_lists
+        postings = {}
+        for position, features in enumerate(feature_lists):
+            if features is None or isinstance(features, float):
+                continue
+            for feature in features:
+                for word in normalize_feature(feature):
+                    postings.setdefault(word, []).append(position)
+        self.vocabulary = sorted(postings)
+        self.bitsets = []
+        for word in self.vocabulary:
+            mask = np.zeros(self.size, dtype=bool)
+            mask[postings[word]] = True
+            self.bitsets.append(to_bitset(mask))
+        self.all = (1 << self.size) - 1
+        self.prefix_bitsets = {}
+        self.phrase_bitsets = {}
+
+    def save(self, path):
+        # the word and phrase bitsets as rows of a packed bit matrix, the
+        # feature lists stay with the properties
+        phrases = list(self.phrase_bitsets)
+        bitsets = self.bitsets + [self.phrase_bitsets[phrase] for phrase in phrases]
+        bits = np.zeros((len(bitsets), (self.size + 7) // 8), dtype=np.uint8)
+        for row, bitset in enumerate(bitsets):
+            bits[row] = np.frombuffer(bitset.to_bytes(bits.shape[1], 'little'), dtype=np.uint8)
+        meta = {'size': self.size, 'signature': self.signature, 'vocabulary': self.vocabulary,
+            'phrases': phrases}
+        with open(path, 'wb') as index_file:
+            np.savez(index_file, bits=bits, meta=json.dumps(meta))
+
+    @classmethod
+    def load(cls, path, feature_lists):
+        # feature_lists are the ones the saved index was built from
+        index = cls([])
+        with np.load(path) as index_file:
+            meta = json.loads(str(index_file['meta']))
+            bitsets = [int.from_bytes(row.tobytes(), 'little') for row in index_file['bits']]
+        index.size = meta['size']
+        index.signature = meta['signature']
+        index.vocabulary = meta['vocabulary']
+        index.bitsets = bitsets[:len(index.vocabulary)]
+        index.phrase_bitsets = dict(zip(map(tuple, meta['phrases']), bitsets[len(index.vocabulary):]))
+        index.feature_lists = feature_lists
+        index.all = (1 << index.size) - 1
+        return index
+
+    def word_bitset(self, prefix):
+        if prefix not in self.prefix_bitsets:
+            bitset = 0
+            i = bisect_left(self.vocabulary, prefix)
+            while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+                bitset |= self.bitsets[i]
+                i = i + 1
+            self.prefix_bitsets[prefix] = bitset
+        return self.prefix_bitsets[prefix]
+
+    def term_bitset(self, term):
+        bitset = self.all
+        for word in normalize_feature(term):
+            bitset &= self.word_bitset(word)
+        return bitset
+
+    def phrase_bitset(self, phrase):
+        # the listings with all the words are the candidates, the phrase is
+        # checked against their features
+        words = normalize_feature(phrase)
+        if len(words) < 2:
+            return self.term_bitset(phrase)
+        key = tuple(words)
+        if key not in self.phrase_bitsets:
+            candidates = self.term_bitset(phrase)
+            mask = np.zeros(self.size, dtype=bool)
+            for position in np.flatnonzero(self.to_mask(candidates)):
+                mask[position] = any(matches_phrase(normalize_feature(feature), words)
+                    for feature in self.feature_lists[position])
+            self.phrase_bitsets[key] = to_bitset(mask)
+        return self.phrase_bitsets[key]
+
+    def query_bitset(self, query):
+        tokens = query_token_re.findall(query)
+        bitset, position = self.parse_or(tokens, 0)
+        if position != len(tokens):
+            raise ValueError('unexpected {!r} in amenity query {!r}'.format(tokens[position], query))
+        return bitset
+
+    def parse_or(self, tokens, position):
+        bitset, position = self.parse_and(tokens, position)
+        while position < len(tokens) and tokens[position] == 'OR':
+            right, position = self.parse_and(tokens, position + 1)
+            bitset |= right
+        return bitset, position
+
+    def parse_and(self, tokens, position):
+        bitset, position = self.parse_not(tokens, position)
+        while position < len(tokens) and tokens[position] not in ('OR', ')'):
+            if tokens[position] == 'AND':
+                position = position + 1
+            right, position = self.parse_not(tokens, position)
+            bitset &= right
+        return bitset, position
+
+    def parse_not(self, tokens, position):
+        if position < len(tokens) and tokens[position] == 'NOT':
+            bitset, position = self.parse_not(tokens, position + 1)
+            return self.all & ~bitset, position
+        return self.parse_atom(tokens, position)
+
+    def parse_atom(self, tokens, position):
+        if position >= len(tokens):
+            raise ValueError('amenity query ends early')
+        token = tokens[position]
+        if token == '(':
+            bitset, position = self.parse_or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise ValueError('missing ) in amenity query')
+            return bitset, position + 1
+        if token in ('AND', 'OR', ')'):
+            raise ValueError('unexpected {!r} in amenity query'.format(token))
+        if token.startswith('"'):
+            return self.phrase_bitset(token.strip('"')), position + 1
+        return self.term_bitset(token), position + 1
+
+    def to_mask(self, bitset):
+        packed = np.frombuffer(bitset.to_bytes((self.size + 7) // 8, 'little'), dtype=np.uint8)
+        return np.unpackbits(packed, bitorder='little')[:self.size].astype(bool)
+
+    def query(self, query):
+        # boolean mask over the listing positions
+        return self.to_mask(self.query_bitset(query))
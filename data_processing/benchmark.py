@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+from canonicalAddress import canonical_address, location_key, parse_coordinates
+import dataStore
+from glob import glob
+import importlib
+import json
+from listingTable import ListingTable
+import os
+from os.path import abspath, basename, dirname, join
+import numpy as np
+import pandas as pd
+import queryEngine
+import random
+from routeCache import RouteCache, normalize_address
+from stationIndex import haversine_miles
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+class FakeClient:
+    # stands in for googlemaps.Client, answering every call after `latency`
+    # seconds. Every address gets its own coordinates near Palo Alto and the
+    # routes are straight lines, api_calls counts the calls of each api and
+    # the matrix elements.
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = 0
+        self.api_calls = {'geocode': 0, 'directions': 0, 'distance_matrix': 0, 'elements': 0}
+        self.lock = threading.Lock()
+
+    def count(self, api, elements=0):
+        with self.lock:
+            self.calls = self.calls + 1
+            self.api_calls[api] = self.api_calls[api] + 1
+            self.api_calls['elements'] = self.api_calls['elements'] + elements
+        time.sleep(self.latency)
+
+    def location(self, address):
+        geocode = parse_coordinates(address)
+        if geocode:
+            return geocode
+        h = zlib.crc32(address.encode())
+        return (37.4 + (h % 1000) / 10000.0, -122.1 - (h // 1000 % 1000) / 10000.0)
+
+    def leg(self, origin, destination, mode):
+        meters = haversine_miles(self.location(origin), self.location(destination)) * 1609.344
+        speed = 1.4 if mode == 'walking' else 13.4
+        return {'duration': {'value': int(meters / speed)}, 'distance': {'value': int(meters)}}
+
+    def geocode(self, address):
+        self.count('geocode')
+        lat, lng = self.location(address)
+        return [{'geometry': {'location': {'lat': lat, 'lng': lng}}}]
+
+    def directions(self, origin, destination, mode=None, departure_time=None):
+        self.count('directions')
+        return [{'legs': [self.leg(origin, destination, mode)]}]
+
+    def distance_matrix(self, origins, destinations, mode=None, departure_time=None):
+        self.count('distance_matrix', len(origins) * len(destinations))
+        return {'status': 'OK', 'rows': [{'elements': [dict(status='OK',
+            **self.leg(origin, destination, mode)) for destination in destinations]}
+            for origin in origins]}
+
+
+def bench_lookup_pool(args):
+    # geocodes through DistanceCalculator.get_geocodes with one worker and
+    # with the lookup pool. The speedup of the pool is measured on distinct
+    # addresses, so both runs make the same calls; the calls saved on
+    # addresses spelled several ways are reported on their own
+    from cacheStore import open_cache
+    from distanceCalculator import DistanceCalculator
+    num_addresses = int(args[0]) if len(args) > 0 else 200
+    latency = float(args[1]) if len(args) > 1 else 0.05
+    max_workers = int(args[2]) if len(args) > 2 else 16
+    qps = float(args[3]) if len(args) > 3 else 1000
+    directory = tempfile.mkdtemp()
+
+    def geocode(addresses, workers):
+        # a fresh geocode cache in a temporary directory for every run, the
+        # configured caches are not touched
+        client = FakeClient(latency)
+        calc = DistanceCalculator(client, workers, qps)
+        calc.cache_geo_code = open_cache('sqlite', join(directory, 'none.json'),
+            join(directory, 'cache{}.sqlite'.format(len(os.listdir(directory)))), 'geocode')
+        start = time.perf_counter()
+        calc.get_geocodes(addresses)
+        elapsed = time.perf_counter() - start
+        calc.pool.close()
+        return client.calls, elapsed
+
+    distinct = ['{} Main St Palo Alto CA 94301'.format(100 + i) for i in range(num_addresses)]
+    calls, serial = geocode(distinct, 1)
+    print('1 worker: {} addresses, {} calls in {:.2f}s'.format(len(distinct), calls, serial))
+    calls, pooled = geocode(distinct, max_workers)
+    print('pool of {}: {} addresses, {} calls in {:.2f}s ({:.1f}x)'.format(
+        max_workers, len(distinct), calls, pooled, serial / pooled))
+
+    spelled = [address for building, address in fake_addresses(num_addresses // 5 or 1)]
+    calls, elapsed = geocode(spelled, max_workers)
+    print('pool of {}: {} spellings of {} buildings, {} calls in {:.2f}s ({} calls saved)'.format(
+        max_workers, len(spelled), num_addresses // 5 or 1, calls, elapsed, len(spelled) - calls))
+    shutil.rmtree(directory)
+
+
+def fake_listings(num_rows):
+    features = ['Washer/Dryer', 'Air Conditioning', 'Dishwasher', 'Carpet',
+        'Hardwood Floors', 'Walk-In Closets', 'Balcony', 'Fireplace', 'Patio']
+    rows = []
+    for i in range(num_rows):
+        rows.append({
+            'name': 'Apartments {}'.format(i // 50),
+            'address': '{} Main St Palo Alto CA 94301'.format(i // 50),
+            'bathroom_num': 1 + (i % 2) * 0.5,
+            'bedroom_num': i % 4,
+            'min_rent': 1500 + (i * 37) % 3000 if i % 17 else float('inf'),
+            'max_rent': 2000 + (i * 37) % 3000 if i % 17 else float('inf'),
+            'unit': str(i % 50),
+            'sqrt_foot': 500 + (i * 13) % 1000,
+            'avail_date': '2026-{:02d}-{:02d}'.format(1 + i % 12, 1 + i % 28),
+            'phone': '(650) 555-{:04d}'.format(i // 50),
+            'url': 'https://www.apartments.com/apartments-{}/'.format(i // 50),
+            'feature_list': random.Random(i // 50).sample(features, 5),
+        })
+    return rows
+
+
+def bench_load(args):
+    # loads the same crawl output from the json feed and from parquet
+    num_rows = int(args[0]) if len(args) > 0 else 50000
+    directory = tempfile.mkdtemp()
+    path = join(directory, 'output.json')
+    with open(path, 'w') as apts_file:
+        json.dump(fake_listings(num_rows), apts_file)
+
+    start = time.perf_counter()
+    with open(path) as apts_file:
+        pd.json_normalize(json.load(apts_file))
+    print('json.load + json_normalize: {:.3f}s'.format(time.perf_counter() - start))
+
+    if not dataStore.columnar:
+        print('pyarrow is not installed, skipping parquet')
+        return
+    dataStore.load_crawl(path)
+    start = time.perf_counter()
+    dataStore.load_crawl(path)
+    print('parquet, all columns: {:.3f}s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    dataStore.load_crawl(path, ['min_rent', 'bedroom_num', 'avail_date'])
+    print('parquet, 3 columns: {:.3f}s'.format(time.perf_counter() - start))
+    print('sizes: json {} bytes, parquet {} bytes'.format(
+        os.path.getsize(path), os.path.getsize(dataStore.columnar_path(path))))
+
+
+def fake_property_page(i, num_units=30, next_page=None):
+    # a property page shaped like the ones ApartmentsSpider.parse_apartment reads
+    rows = []
+    for unit in range(num_units):
+        rows.append('''
+            <tr class="rentalGridRow">
+              <td class="beds"><span class="shortText">{bed} BR</span><span class="longText">{bed} Bedrooms</span></td>
+              <td class="baths"><span class="shortText">{bath} BA</span><span class="longText">{bath} Bathrooms</span></td>
+              <td class="rent">${rent:,} - {max_rent:,}</td>
+              <td class="sqft">{sqft:,} Sq Ft</td>
+              <td class="unit">{unit}</td>
+              <td class="available">{avail}</td>
+            </tr>'''.format(bed=unit % 4, bath='1\u00bd' if unit % 3 else '2',
+                rent=1500 + unit * 25, max_rent=1600 + unit * 25, sqft=550 + unit * 10,
+                unit=100 + unit, avail='Available Now' if unit % 5 == 0 else 'Dec 1'))
+    return '''<html><head><title>Apartments {i}</title></head><body>
+      <h1 class="propertyName">Apartments {i} at Main</h1>
+      <div class="propertyAddress">
+        <span itemprop="streetAddress">{i} Main St</span>
+        <span itemprop="addressLocality">Palo Alto</span>,
+        <span itemprop="addressRegion">CA</span>
+        <span itemprop="postalCode">94301</span>
+      </div>
+      <span class="contactPhone">(650) 555-{i:04d}</span>
+      <div class="tabContent active"><div><table class="availabilityTable"><tbody>{rows}
+      </tbody></table></div></div>
+      <section><h3>Features</h3><ul><li>Washer/Dryer</li><li>Air Conditioning</li><li>Dishwasher</li></ul></section>
+      {next_page}
+    </body></html>'''.format(i=i, rows=''.join(rows),
+        next_page='<a class="next " href="{}">Next</a>'.format(next_page) if next_page else '')
+
+
+def import_spider():
+    # the spiders live in the scrapy project package one level up
+    package_dir = dirname(dirname(abspath(__file__)))
+    sys.path.insert(0, dirname(package_dir))
+    return importlib.import_module(basename(package_dir) + '.spiders.apartments')
+
+
+def bench_parse(args):
+    # cpu time of ApartmentsSpider.parse_apartment over saved html pages,
+    # either the *.html files in a directory or generated pages
+    from scrapy.http import HtmlResponse
+    apartments = import_spider()
+    if args and os.path.isdir(args[0]):
+        pages = []
+        for path in sorted(glob(join(args[0], '*.html'))):
+            with open(path, 'rb') as page:
+                pages.append(page.read())
+    else:
+        pages = [fake_property_page(i).encode('utf-8')
+            for i in range(int(args[0]) if args else 200)]
+    responses = [HtmlResponse(url='https://www.apartments.com/apartments-{}/'.format(i),
+        body=body, encoding='utf-8') for i, body in enumerate(pages)]
+    for response in responses:
+        response.selector
+    spider = apartments.ApartmentsSpider()
+    start = time.process_time()
+    items = 0
+    for response in responses:
+        items = items + sum(1 for item in spider.parse_apartment(response) if isinstance(item, dict))
+    elapsed = time.process_time() - start
+    print('{} pages, {} units in {:.3f}s cpu: {:.0f} pages/s'.format(
+        len(responses), items, elapsed, len(responses) / elapsed))
+
+
+def bench_rank(args):
+    # ranks the same listings under many weight profiles, building the
+    # normalized matrix once
+    num_rows = int(args[0]) if len(args) > 0 else 50000
+    num_profiles = int(args[1]) if len(args) > 1 else 100
+    data = pd.DataFrame(fake_listings(num_rows))
+    data['time_to_fb_at_9'] = [random.uniform(5, 60) for _ in range(num_rows)]
+    columns = ['min_rent', 'time_to_fb_at_9', 'sqrt_foot', 'bedroom_num']
+    mask = np.ones(num_rows, dtype=bool)
+
+    start = time.perf_counter()
+    for _ in range(num_profiles):
+        data.sort_values('min_rent').head(10)
+    print('full sort by min_rent: {:.2f}ms per query'.format(
+        (time.perf_counter() - start) * 1000 / num_profiles))
+
+    start = time.perf_counter()
+    ranker = queryEngine.Ranker(data, mask, columns)
+    print('normalizing {} rows: {:.2f}ms'.format(num_rows, (time.perf_counter() - start) * 1000))
+    start = time.perf_counter()
+    for _ in range(num_profiles):
+        ranker.top_k(dict((column, random.random()) for column in columns), 10)
+    print('weighted top 10: {:.2f}ms per profile'.format(
+        (time.perf_counter() - start) * 1000 / num_profiles))
+
+
+def bench_memory(args):
+    # resident size of the same listings as the flat per unit frame and as
+    # a ListingTable, and the time of a filter on each
+    num_rows = int(args[0]) if len(args) > 0 else 50000
+    items = fake_listings(num_rows)
+    flat = dataStore.normalize_types(pd.json_normalize(items))
+    listings = ListingTable.from_items(items)
+    flat_bytes = flat.memory_usage(deep=True).sum()
+    print('flat frame: {:.1f} MB'.format(flat_bytes / 1e6))
+    print('listing table: {:.1f} MB ({} properties, {:.1f}x smaller)'.format(
+        listings.memory_usage() / 1e6, listings.properties.shape[0],
+        flat_bytes / listings.memory_usage()))
+    data = listings.frame()
+    print('joined query frame: {:.1f} MB'.format(data.memory_usage(deep=True).sum() / 1e6))
+    predicates = [('bedroom_num', '>=', 2), ('min_rent', '<=', 3000)]
+    for name, frame in (('flat', flat), ('joined', data)):
+        start = time.perf_counter()
+        for _ in range(100):
+            queryEngine.run_query(frame, predicates, 10)
+        print('{} top 10: {:.2f}ms per query'.format(name, (time.perf_counter() - start) * 10))
+
+
+def fake_addresses(num_buildings, spellings=5):
+    # (building, address) of the same buildings spelled the ways different
+    # listing pages spell them
+    streets = [('Main', 'Street', 'St'), ('University', 'Avenue', 'Ave'),
+        ('Page Mill', 'Road', 'Rd'), ('Embarcadero', 'Boulevard', 'Blvd'), ('Hamilton', 'Court', 'Ct')]
+    variants = [
+        '{number} {street} {suffix} Palo Alto CA 94301',
+        '{number} {street} {abbreviation} Palo Alto CA 94301',
+        '{number} {street} {suffix}, Apt {unit}, Palo Alto, CA 94301-1234',
+        '{number}  {street} {abbreviation}. PALO ALTO CA 94301',
+        '{number} {street} {abbreviation} #{unit} Palo Alto CA 94301',
+        '{number} {street} {suffix} Unit {unit} Palo Alto CA 94301',
+        # only the geocode tells that this is the same building
+        '{number} {street} {suffix}, Palo Alto, California',
+    ]
+    choices = random.Random(0)
+    addresses = []
+    for building in range(num_buildings):
+        street, suffix, abbreviation = streets[building % len(streets)]
+        for _ in range(spellings):
+            addresses.append((building, choices.choice(variants).format(number=100 + building,
+                street=street, suffix=suffix, abbreviation=abbreviation, unit=choices.randint(1, 300))))
+    return addresses
+
+
+def hit_rate(keys):
+    # the share of lookups answered by an earlier lookup of the same key
+    return 1 - len(set(keys)) / len(keys) if keys else 0.0
+
+
+def bench_addresses(args):
+    # cache hit rates of the geocode and routing lookups of a corpus of
+    # differently spelled addresses, keyed the old way (whitespace and case
+    # normalized) and on canonical addresses and rounded coordinates
+    num_buildings = int(args[0]) if len(args) > 0 else 500
+    spellings = int(args[1]) if len(args) > 1 else 5
+    corpus = fake_addresses(num_buildings, spellings)
+    addresses = [address for building, address in corpus]
+    print('{} addresses of {} buildings'.format(len(addresses), num_buildings))
+    for name, keys in (('raw', addresses),
+            ('normalized', [normalize_address(address) for address in addresses]),
+            ('canonical', [canonical_address(address) for address in addresses])):
+        print('geocode keys {}: {} distinct, hit rate {:.1%}'.format(
+            name, len(set(keys)), hit_rate(keys)))
+
+    # geocodes of the same building differ by a meter or two between spellings
+    jitter = random.Random(1)
+    geocodes = dict((address, (37.4 + building * 0.001 + jitter.uniform(-1e-5, 1e-5),
+        -122.1 - building * 0.001 + jitter.uniform(-1e-5, 1e-5))) for building, address in corpus)
+    dest = '1 Hacker Way, Menlo Park, CA 94025'
+    old_keys = [normalize_address(address) + normalize_address(dest) for address in addresses]
+    print('route keys normalized: {} api calls, hit rate {:.1%}'.format(
+        len(set(old_keys)), hit_rate(old_keys)))
+    cache = RouteCache({}, locate=lambda address: location_key(geocodes[address])
+        if address in geocodes else None)
+    for address in addresses:
+        if cache.get(address, dest, 'driving', 9) is None:
+            cache.put(address, dest, 'driving', 9, {'duration': 10.0, 'distance': 5.0})
+    stats = cache.stats()
+    print('route keys located: {} api calls, hit rate {:.1%}'.format(
+        stats['misses'], stats['hits'] / (stats['hits'] + stats['misses'])))
+
+
+benchmarks = {
+    'addresses': bench_addresses,
+    'load': bench_load,
+    'memory': bench_memory,
+    'rank': bench_rank,
+    'parse': bench_parse,
+    'lookup_pool': bench_lookup_pool,
+}
+
+# main
+def main(argv):
+    if len(argv) < 2 or argv[1] not in benchmarks:
+        print('usage: %s {%s} [args...]' % (argv[0], '|'.join(sorted(benchmarks))))
+        return 100
+    benchmarks[argv[1]](argv[2:])
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
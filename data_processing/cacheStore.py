@@ -0,0 +1,104 @@
+from collections.abc import MutableMapping
+import json
+import os
+from os.path import isfile
+import sqlite3
+import threading
+
+
+class SqliteCache(MutableMapping):
+    # dict-like view of one table in a sqlite file. Every assignment is its
+    # own committed transaction, so entries are written incrementally and a
+    # crash can at worst lose the entry being written. Values are only read
+    # from disk when they are looked up.
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL)'.format(table))
+
+    def execute(self, statement, parameters=()):
+        with self.lock:
+            return self.connection.execute(statement.format(self.table), parameters).fetchall()
+
+    def __getitem__(self, key):
+        rows = self.execute('SELECT value FROM {} WHERE key = ?', (key,))
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        self.execute('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)',
+            (key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.execute('DELETE FROM {} WHERE key = ?', (key,))
+
+    def __contains__(self, key):
+        return bool(self.execute('SELECT 1 FROM {} WHERE key = ?', (key,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.execute('SELECT key FROM {}')])
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM {}')[0][0]
+
+    def update_many(self, items):
+        # one transaction for a bulk load such as importing an old json cache
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(self.table),
+                    [(key, json.dumps(value)) for key, value in items])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class JsonCache(dict):
+    # the whole cache in memory, written out as a single json file. The new
+    # file is written next to the old one and swapped in with os.replace, so
+    # an interrupted save leaves the previous file intact.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if isfile(path):
+            with open(path) as cacheFile:
+                self.update(json.load(cacheFile))
+
+    def flush(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cacheFile:
+            json.dump(self, cacheFile)
+            cacheFile.flush()
+            os.fsync(cacheFile.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+
+def open_cache(backend, json_path, db_path, table):
+    # json_path is the legacy whole-file cache. The sqlite backend imports it
+    # once, the first time its table is empty.
+    if backend == 'json':
+        return JsonCache(json_path)
+    if backend != 'sqlite':
+        raise ValueError('unknown cache backend {}'.format(backend))
+    cache = SqliteCache(db_path, table)
+    if len(cache) == 0 and isfile(json_path):
+        print('importing {} into {}...'.format(json_path, db_path))
+        with open(json_path) as cacheFile:
+            cache.update_many(json.load(cacheFile).items())
+    return cache
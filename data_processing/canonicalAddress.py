@@ -0,0 +1,89 @@
+import re
+
+# USPS standard abbreviations (Publication 28) of the street suffixes and
+# directionals, both spellings of an address key on the abbreviation
+street_suffixes = {
+    'alley': 'aly', 'allee': 'aly', 'ally': 'aly',
+    'avenue': 'ave', 'av': 'ave', 'aven': 'ave', 'avenu': 'ave', 'avn': 'ave', 'avnue': 'ave',
+    'boulevard': 'blvd', 'boul': 'blvd', 'boulv': 'blvd',
+    'circle': 'cir', 'circ': 'cir', 'circl': 'cir', 'crcl': 'cir', 'crcle': 'cir',
+    'center': 'ctr', 'centre': 'ctr', 'cent': 'ctr', 'centr': 'ctr', 'cnter': 'ctr', 'cntr': 'ctr',
+    'court': 'ct', 'courts': 'cts',
+    'crossing': 'xing', 'crssng': 'xing',
+    'drive': 'dr', 'driv': 'dr', 'drv': 'dr',
+    'expressway': 'expy', 'exp': 'expy', 'expr': 'expy', 'express': 'expy', 'expw': 'expy',
+    'freeway': 'fwy', 'frway': 'fwy', 'frwy': 'fwy',
+    'highway': 'hwy', 'highwy': 'hwy', 'hiway': 'hwy', 'hiwy': 'hwy', 'hway': 'hwy',
+    'lane': 'ln',
+    'parkway': 'pkwy', 'parkwy': 'pkwy', 'pkway': 'pkwy', 'pky': 'pkwy',
+    'place': 'pl',
+    'plaza': 'plz', 'plza': 'plz',
+    'point': 'pt',
+    'road': 'rd', 'roads': 'rds',
+    'square': 'sq', 'sqr': 'sq', 'sqre': 'sq', 'squ': 'sq',
+    'street': 'st', 'strt': 'st', 'str': 'st', 'streets': 'sts',
+    'terrace': 'ter', 'terr': 'ter',
+    'trail': 'trl', 'trails': 'trl', 'trls': 'trl',
+    'turnpike': 'tpke', 'trnpk': 'tpke', 'turnpk': 'tpke',
+}
+directionals = {
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+}
+abbreviations = dict(street_suffixes, **directionals)
+# the suffixes that end the street line
+suffix_abbreviations = set(street_suffixes.values()) | {'way', 'loop', 'row', 'walk', 'path'}
+
+# secondary unit designators, the designator and the unit after it are
+# dropped since every unit of a building shares its geocode and routes.
+# 'fl' is left out, it is the state code of Florida as well.
+unit_designators = {'apt', 'apartment', 'unit', 'ste', 'suite', 'rm', 'room',
+    'floor', 'bldg', 'building', 'lot', 'spc', 'space', '#'}
+
+token_re = re.compile(r"#|[a-z0-9]+(?:['/-][a-z0-9]+)*")
+zip_re = re.compile(r'^\d{5}(-\d{4})?$')
+zip_plus_four_re = re.compile(r'^(\d{5})-\d{4}$')
+coordinates_re = re.compile(r'(-?\d+\.\d+),\s*(-?\d+\.\d+)')
+
+
+def is_unit(token):
+    return (len(token) == 1 or any(c.isdigit() for c in token)) and not zip_re.match(token)
+
+
+def canonical_address(address):
+    # '123 Main Street, Apt #4B, Palo Alto, CA 94301-1234' and
+    # '123  MAIN ST palo alto ca 94301' -> '123 main st palo alto ca 94301'.
+    # A unit is only dropped after the street suffix, so that street names
+    # such as '45 Building 5 Rd' and the locality stay whole.
+    tokens = token_re.findall(address.lower())
+    canonical = []
+    street_line = False
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in unit_designators and street_line and i + 1 < len(tokens):
+            # '# 4b', 'apt # 4b'
+            following = i + 2 if tokens[i + 1] == '#' and i + 2 < len(tokens) else i + 1
+            if is_unit(tokens[following]):
+                i = following + 1
+                continue
+        match = zip_plus_four_re.match(token)
+        canonical.append(match.group(1) if match else abbreviations.get(token, token))
+        # the number and the street name come before the suffix
+        street_line = street_line or (len(canonical) > 2 and canonical[-1] in suffix_abbreviations)
+        i = i + 1
+    if canonical and canonical[-1] == 'usa':
+        canonical.pop()
+    return ' '.join(canonical)
+
+
+def parse_coordinates(address):
+    # stations and commute grid nodes carry their coordinates, '37.4, -122.1'
+    match = coordinates_re.search(address)
+    return (float(match.group(1)), float(match.group(2))) if match else None
+
+
+def location_key(geocode, digits=4):
+    # 4 decimal digits are about 10 meters, the same building
+    return '{:.{digits}f},{:.{digits}f}'.format(round(geocode[0], digits) + 0.0,
+        round(geocode[1], digits) + 0.0, digits=digits)
@@ -0,0 +1,114 @@
+from commuteMatrix import compute_commutes, prefetch_commutes
+import json
+import math
+import numpy as np
+from stationIndex import haversine_miles_many
+import time
+
+miles_per_degree = 69.0
+
+
+def node_address(lat, lng):
+    # grid nodes are routed by their coordinates
+    return '{:.5f}, {:.5f}'.format(lat, lng)
+
+
+class CommuteGrid:
+    # Travel times from a regular lat/lng grid, routed once through the
+    # DistanceCalculator. estimate() interpolates bilinearly between the four
+    # nodes around a listing, listings outside the grid or next to an
+    # unroutable or unrouted node get nan.
+    def __init__(self, south, west, lat_step, lng_step, columns, values, step_miles, built_at=None):
+        self.south = south
+        self.west = west
+        self.lat_step = lat_step
+        self.lng_step = lng_step
+        self.columns = list(columns)
+        # (rows, cols, len(columns)) float32
+        self.values = values
+        self.step_miles = step_miles
+        self.built_at = built_at or time.time()
+
+    @classmethod
+    def build(cls, distance_calc, geocodes, specs, step_miles=0.5, matrix=True,
+            max_nodes=2000, max_radius_miles=50):
+        # only the four nodes around the cell of every geocode are routed,
+        # the others stay nan. Geocodes more than max_radius_miles from the
+        # median one are left out, they are mostly wrong geocodes of a street
+        # name in another city. Above max_nodes the step is doubled until
+        # the nodes fit. step_miles stays the requested step, rank_apts
+        # rebuilds the grid when it changes. Columns are time_to_shuttle
+        # and the commute specs.
+        lats = np.array([geocode[0] for geocode in geocodes], dtype=float)
+        lngs = np.array([geocode[1] for geocode in geocodes], dtype=float)
+        distances = haversine_miles_many(lats, lngs, (np.median(lats), np.median(lngs)))
+        near = (distances <= max_radius_miles) | (distances == distances.min())
+        if not near.all():
+            print('left {} outlying geocodes out of the commute grid'.format(int((~near).sum())))
+        lats = lats[near]
+        lngs = lngs[near]
+        node_step = step_miles
+        while True:
+            # one step of padding around the bounding box of the geocodes
+            lat_step = node_step / miles_per_degree
+            lng_step = node_step / (miles_per_degree * math.cos(math.radians(lats.mean())))
+            south = lats.min() - lat_step
+            west = lngs.min() - lng_step
+            rows = int(math.ceil((lats.max() + lat_step - south) / lat_step)) + 1
+            cols = int(math.ceil((lngs.max() + lng_step - west) / lng_step)) + 1
+            cells = np.unique(np.floor((lats - south) / lat_step).astype(int) * cols
+                + np.floor((lngs - west) / lng_step).astype(int))
+            node_ids = np.unique(np.concatenate([cells, cells + 1, cells + cols, cells + cols + 1]))
+            if len(node_ids) <= max(max_nodes, 4):
+                break
+            node_step = node_step * 2
+        if node_step != step_miles:
+            print('coarsened the commute grid to {} mile steps to stay within {} nodes'.format(
+                node_step, max_nodes))
+        nodes = [node_address(south + (k // cols) * lat_step, west + (k % cols) * lng_step)
+            for k in node_ids]
+        print('routing {} nodes of a {} x {} commute grid with {} mile steps...'.format(
+            len(nodes), rows, cols, node_step))
+        # the nodes are their own geocodes (see DistanceCalculator.cached_geocode),
+        # no geocode api call needed
+        distance_calc.prefetch_approx_stations_with_shortest_time(nodes, matrix=matrix)
+        shuttle = np.array([[distance_calc.find_approx_station_with_shortest_time(node)['time_to_shuttle']]
+            for node in nodes], dtype=np.float32)
+        prefetch_commutes(distance_calc, nodes, specs, matrix)
+        values = np.full((rows * cols, 1 + len(specs)), np.nan, dtype=np.float32)
+        values[node_ids] = np.hstack([shuttle, compute_commutes(distance_calc, nodes, specs)])
+        distance_calc.save_cache()
+        return cls(south, west, lat_step, lng_step,
+            ['time_to_shuttle'] + [spec['name'] for spec in specs],
+            values.reshape(rows, cols, -1), step_miles)
+
+    def save(self, path):
+        meta = {'south': self.south, 'west': self.west, 'lat_step': self.lat_step,
+            'lng_step': self.lng_step, 'columns': self.columns,
+            'step_miles': self.step_miles, 'built_at': self.built_at}
+        with open(path, 'wb') as grid_file:
+            np.savez(grid_file, values=self.values, meta=json.dumps(meta))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as grid_file:
+            meta = json.loads(str(grid_file['meta']))
+            return cls(meta['south'], meta['west'], meta['lat_step'], meta['lng_step'],
+                meta['columns'], grid_file['values'], meta['step_miles'], meta['built_at'])
+
+    def estimate(self, lats, lngs):
+        # {column: float array} of the interpolated values
+        rows, cols = self.values.shape[:2]
+        y = (np.asarray(lats, dtype=float) - self.south) / self.lat_step
+        x = (np.asarray(lngs, dtype=float) - self.west) / self.lng_step
+        inside = (y >= 0) & (y < rows - 1) & (x >= 0) & (x < cols - 1)
+        i = np.where(inside, np.floor(y), 0).astype(int)
+        j = np.where(inside, np.floor(x), 0).astype(int)
+        dy = (np.where(inside, y, 0) - i)[:, None]
+        dx = (np.where(inside, x, 0) - j)[:, None]
+        values = self.values.astype(float)
+        estimates = values[i, j] * (1 - dy) * (1 - dx) + values[i + 1, j] * dy * (1 - dx) \
+            + values[i, j + 1] * (1 - dy) * dx + values[i + 1, j + 1] * dy * dx
+        estimates[~inside] = np.nan
+        estimates[~np.isfinite(estimates)] = np.nan
+        return dict((column, estimates[:, k]) for k, column in enumerate(self.columns))
@@ -0,0 +1,67 @@
+import config
+from config import loc
+import numpy as np
+
+# A commute is one derived column: the duration (min) or distance (mile) of
+# the route between a listing and dest by mode, leaving at hour, either to
+# dest or back from it. The defaults are the columns rank_apts always had.
+legacy_commutes = [
+    {'name': 'distance_to_fb', 'dest': loc, 'mode': 'walking', 'hour': 9,
+        'direction': 'to', 'value': 'distance'},
+    {'name': 'time_to_fb_at_9', 'dest': loc, 'mode': 'driving', 'hour': 9,
+        'direction': 'to', 'value': 'duration'},
+    {'name': 'time_from_fb_at_18', 'dest': loc, 'mode': 'driving', 'hour': 18,
+        'direction': 'from', 'value': 'duration'},
+]
+
+
+def expand_commute_matrix(matrix):
+    # config.commute_matrix = {'destinations': {'work': '1 Main St ...'},
+    #     'modes': ['driving', 'transit'], 'hours': [8, 10]}
+    # adds a time_to_<name>_<mode>_at_<hour> column for every combination,
+    # 'directions': ['to', 'from'] adds the time_from_ columns as well
+    return [{'name': 'time_{}_{}_{}_at_{}'.format(direction, name, mode, hour),
+            'dest': dest, 'mode': mode, 'hour': hour,
+            'direction': direction, 'value': 'duration'}
+        for name, dest in sorted(matrix['destinations'].items())
+        for mode in matrix.get('modes', ['driving'])
+        for hour in matrix.get('hours', [9])
+        for direction in matrix.get('directions', ['to'])]
+
+
+def commute_specs():
+    # config.commutes replaces the legacy columns, config.commute_matrix
+    # adds to them
+    specs = list(getattr(config, 'commutes', legacy_commutes))
+    matrix = getattr(config, 'commute_matrix', None)
+    if matrix:
+        specs = specs + expand_commute_matrix(matrix)
+    return specs
+
+
+def route_of(spec, address):
+    if spec['direction'] == 'from':
+        return spec['dest'], address
+    return address, spec['dest']
+
+
+def prefetch_commutes(distance_calc, addresses, specs, matrix=True):
+    # every route the commutes need goes to the lookup pool at once
+    distance_calc.prefetch_routes(
+        [route_of(spec, address) + (spec['mode'], spec['hour'])
+            for spec in specs for address in addresses], matrix)
+
+
+def compute_commutes(distance_calc, addresses, specs, needs=None):
+    # (len(addresses), len(specs)) float32 array of the commutes, needs(i, j)
+    # says whether cell i, j is wanted, the others stay nan. Commutes that
+    # share a route (e.g. its distance and duration) share one cache entry,
+    # the routes are read as prefetch_commutes looked them up.
+    values = np.full((len(addresses), len(specs)), np.nan, dtype=np.float32)
+    for i, address in enumerate(addresses):
+        for j, spec in enumerate(specs):
+            if needs is None or needs(i, j):
+                start, dest = route_of(spec, address)
+                values[i, j] = distance_calc.route(start, dest, spec['mode'], spec['hour'],
+                    count=False)[spec['value']]
+    return values
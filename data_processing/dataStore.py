@@ -0,0 +1,124 @@
+import json
+from listingTable import ListingTable
+import os
+from os.path import getmtime, isfile, splitext
+import pandas as pd
+import sqlite3
+
+# parquet needs pyarrow, without it the frames stay json records
+try:
+    import pyarrow
+    columnar = True
+except ImportError:
+    columnar = False
+
+numeric_columns = ['min_rent', 'max_rent', 'sqrt_foot', 'bathroom_num', 'bedroom_num']
+
+
+def columnar_path(path):
+    return splitext(path)[0] + '.parquet'
+
+
+def normalize_types(data):
+    # crawl output encodes a missing rent as Infinity and a missing date as
+    # date.max, store them as NaN / NaT in typed columns instead
+    for column in numeric_columns:
+        if column in data.columns:
+            data[column] = pd.to_numeric(data[column], errors='coerce')\
+                .replace([float('inf'), float('-inf')], float('nan'))
+    if 'avail_date' in data.columns:
+        data['avail_date'] = pd.to_datetime(data['avail_date'], errors='coerce')
+    return data
+
+
+def save_frame(data, path):
+    if columnar:
+        path = columnar_path(path)
+    tmp_path = path + '.tmp'
+    if columnar:
+        data.to_parquet(tmp_path, index=False)
+    else:
+        data.to_json(path_or_buf=tmp_path, orient='records', date_format='iso')
+    os.replace(tmp_path, path)
+
+
+def frame_exists(path):
+    return isfile(columnar_path(path) if columnar else path)
+
+
+def load_frame(path, columns=None):
+    # only reads the given columns when stored as parquet
+    if columnar:
+        return pd.read_parquet(columnar_path(path), columns=columns, memory_map=True)
+    data = normalize_types(pd.read_json(path, orient='records'))
+    return data[columns] if columns else data
+
+
+def load_crawl(path, columns=None):
+    # the scrapy feed is a json array, it is converted once to a typed
+    # columnar copy next to it and later loads read that copy
+    if columnar and isfile(columnar_path(path)) and \
+            getmtime(columnar_path(path)) >= getmtime(path):
+        return load_frame(path, columns)
+    with open(path) as apts_file:
+        apts_info = json.load(apts_file)
+    data = normalize_types(pd.json_normalize(apts_info))
+    if columnar:
+        save_frame(data, path)
+    return data[columns] if columns else data
+
+
+def table_paths(path):
+    # output.json -> output.properties.json, output.units.json
+    root, ext = splitext(path)
+    return root + '.properties' + ext, root + '.units' + ext
+
+
+def store_mtime(path):
+    # a sqlite store in WAL mode is written to its -wal file first
+    return max(getmtime(store_path) for store_path in (path, path + '-wal') if isfile(store_path))
+
+
+def load_listing_table(path, store_path=None):
+    # like load_crawl, but split into a ListingTable. The split tables are
+    # stored as parquet next to the feed and later loads read them. With a
+    # listing store at store_path the tables are rebuilt from the store
+    # whenever it is newer than them, otherwise from the feed.
+    from_store = store_path is not None and isfile(store_path)
+    source_mtime = store_mtime(store_path) if from_store else getmtime(path)
+    properties_path, units_path = table_paths(path)
+    if columnar and all(isfile(columnar_path(table_path)) and
+            getmtime(columnar_path(table_path)) >= source_mtime
+            for table_path in (properties_path, units_path)):
+        return ListingTable(load_frame(properties_path), load_frame(units_path))
+    if from_store:
+        listings = load_listings(store_path)
+    else:
+        with open(path) as apts_file:
+            listings = ListingTable.from_items(json.load(apts_file))
+    if columnar:
+        save_frame(listings.properties, properties_path)
+        save_frame(listings.units, units_path)
+    return listings
+
+
+def remove_frame(path):
+    for stored_path in (path, columnar_path(path)):
+        if isfile(stored_path):
+            os.remove(stored_path)
+
+
+def load_listings(path, since=None):
+    # the listing store the crawl pipeline streams into as a ListingTable,
+    # optionally only the listings written after the `since` timestamp
+    connection = sqlite3.connect(path)
+    try:
+        query = 'SELECT item FROM listings'
+        parameters = ()
+        if since is not None:
+            query = query + ' WHERE crawled_at > ?'
+            parameters = (since,)
+        items = [json.loads(row[0]) for row in connection.execute(query, parameters)]
+    finally:
+        connection.close()
+    return ListingTable.from_items(items)
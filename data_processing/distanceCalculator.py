@@ -1,12 +1,24 @@
 from config import google_api_key, loc, data_path, map_cache_data_path, \
     station_cache_data_path, geocode_cache_data_path
+from cacheStore import open_cache
+from canonicalAddress import canonical_address, location_key, parse_coordinates
+import config
 from datetime import timedelta, datetime
 import googlemaps
 import json
+import logging
+from lookupPool import LookupPool
 import math
-import os
-from os.path import isfile, join
+import numpy as np
+from os.path import dirname, join
+import pandas as pd
+from profiler import profiler
 import re
+from routeCache import RouteCache
+from stationIndex import StationIndex, haversine_miles_many, is_geocode
+import threading
+
+logger = logging.getLogger(__name__)
 
 class DistanceCalculator:
     gmaps = googlemaps.Client(key=google_api_key)
@@ -16,26 +28,60 @@ class DistanceCalculator:
     cache_smallest_station = {}
     cache_geo_code = {}
     direction_api_calls = 0
+    distance_matrix_api_calls = 0
     geocode_api_calls = 0
-    def __init__(self):
+
+    # google distance matrix api limits per request
+    max_matrix_origins = 25
+    max_matrix_destinations = 25
+    max_matrix_elements = 100
+
+    def __init__(self, client=None, max_workers=None, qps=None):
+        # client replaces the googlemaps.Client, e.g. with a local stub
+        if client is not None:
+            self.gmaps = client
+        # guards the caches and counters shared with the lookup pool
+        self.lock = threading.RLock()
+        self.pool = LookupPool(
+            max_workers or getattr(config, 'max_lookup_workers', 8),
+            qps or getattr(config, 'lookup_qps', 10),
+            is_transient=self.is_transient_error)
         self.data_path = data_path
         with open(self.data_path) as dataFile:
             self.stations = json.load(dataFile)['locations']
         self.stations_geocode = [self.get_geocode_from_station(station) for station in self.stations]
+        self.station_index = StationIndex(self.stations_geocode)
         self.loc = loc
+        # a road is at least detour_factor times longer than the straight
+        # line and nobody walks faster than max_walking_mph, 1.0 keeps the
+        # estimates true lower bounds
+        self.detour_factor = getattr(config, 'detour_factor', 1.0)
+        self.max_walking_mph = getattr(config, 'max_walking_mph', 4.0)
         self.map_cache_data_path = map_cache_data_path
         self.station_cache_data_path = station_cache_data_path
         self.geocode_cache_data_path = geocode_cache_data_path
+        # 'sqlite' writes every entry as it is added, 'json' keeps the old
+        # whole-file dumps
+        self.cache_backend = getattr(config, 'cache_backend', 'sqlite')
+        self.cache_db_path = getattr(config, 'cache_db_path',
+            join(dirname(self.map_cache_data_path), 'cache.sqlite'))
 
-        if isfile(self.map_cache_data_path):
-            with open(self.map_cache_data_path) as cacheFile:
-                self.cache = json.load(cacheFile)
-        if isfile(self.map_cache_data_path):
-            with open(self.station_cache_data_path) as cacheFile:
-                self.cache_smallest_station = json.load(cacheFile)
-        if isfile(self.geocode_cache_data_path):
-            with open(self.geocode_cache_data_path) as cacheFile:
-                self.cache_geo_code = json.load(cacheFile)
+        # the routes and shuttle stations of an address with a known geocode
+        # are cached on its coordinates rounded to route_key_digits decimals
+        self.route_key_digits = getattr(config, 'route_key_digits', 4)
+        self.locations = {}
+        # the geocode and station keys already counted as a profiler lookup
+        self.counted = {'geocode': set(), 'station': set()}
+        # driving times depend on traffic, so by default they go stale after a week
+        self.cache = RouteCache(
+            open_cache(self.cache_backend, self.map_cache_data_path, self.cache_db_path, 'map'),
+            getattr(config, 'routing_cache_ttl', {'driving': 7 * 24 * 3600}),
+            getattr(config, 'routing_cache_max_entries', 100000),
+            self.location_of)
+        self.cache_smallest_station = open_cache(self.cache_backend,
+            self.station_cache_data_path, self.cache_db_path, 'station')
+        self.cache_geo_code = open_cache(self.cache_backend,
+            self.geocode_cache_data_path, self.cache_db_path, 'geocode')
         now = datetime.now()
         self.departure_time = timedelta(days=(7-now.weekday())) + now
 
@@ -44,45 +90,215 @@ class DistanceCalculator:
         if m:
             return (float(m.group(1)), float(m.group(2)))
 
+    def is_transient_error(self, exception):
+        if isinstance(exception, googlemaps.exceptions.ApiError):
+            return exception.status in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+        return isinstance(exception, (
+            googlemaps.exceptions.Timeout,
+            googlemaps.exceptions.TransportError,
+            googlemaps.exceptions._RetriableRequest))
+
     def save_cache(self):
-        if isfile(self.map_cache_data_path):
-            print('deleting old map cache file...')
-            os.remove(self.map_cache_data_path)
-        if isfile(self.station_cache_data_path):
-            print('deleting old station cache file...')
-            os.remove(self.station_cache_data_path)
-        print('saving map cache data...')
-        with open(self.map_cache_data_path, 'w') as cacheFile:
-            json.dump(self.cache, cacheFile)
-        print('saving station cache data...')
-        with open(self.station_cache_data_path, 'w') as cacheFile:
-            json.dump(self.cache_smallest_station, cacheFile)
-        with open(self.geocode_cache_data_path, 'w') as cacheFile:
-            json.dump(self.cache_geo_code, cacheFile)
+        with self.lock:
+            self.write_cache()
 
-    def calculate_distance_and_duration(self, start, dest, mode, departure_hour=9):
-        departure_time = datetime(
+    def write_cache(self):
+        self.cache.flush()
+        self.cache_smallest_station.flush()
+        self.cache_geo_code.flush()
+
+    def get_departure_time(self, departure_hour):
+        return datetime(
             self.departure_time.year,
             self.departure_time.month,
             self.departure_time.day,
             departure_hour)
+
+    def calculate_route(self, start, dest, mode, departure_hour=9):
+        departure_time = self.get_departure_time(departure_hour)
         try:
-            self.direction_api_calls = self.direction_api_calls + 1
-            if (self.direction_api_calls % 30 == 0):
-                print('save cache...')
-                self.save_cache()
-            print("number of direction api cals: {}".format(self.direction_api_calls))
-            directions_result = self.gmaps.directions(
-                start, dest, mode, departure_time=departure_time)
+            with self.lock:
+                self.direction_api_calls = self.direction_api_calls + 1
+                if (self.direction_api_calls % 30 == 0):
+                    logger.debug('save cache...')
+                    self.save_cache()
+                logger.debug("number of direction api calls: %d", self.direction_api_calls)
+            profiler.count('api.directions')
+            with profiler.timed('api.directions'):
+                directions_result = self.gmaps.directions(
+                    start, dest, mode, departure_time=departure_time)
         except:
-            print('google map direction api error')
+            logger.error('google map direction api error')
             self.save_cache()
             raise
         if (not directions_result) or (not directions_result[0]['legs']):
-            return math.inf, math.inf
+            return {'duration': math.inf, 'distance': math.inf, 'polyline_length': None}
+        else:
+            polyline = directions_result[0].get('overview_polyline', {}).get('points')
+            return {
+                'duration': self.second_to_minute(directions_result[0]['legs'][0]['duration']['value']),
+                'distance': self.meter_to_mile(directions_result[0]['legs'][0]['distance']['value']),
+                'polyline_length': len(googlemaps.convert.decode_polyline(polyline)) if polyline else None,
+                }
+
+    def calculate_distance_and_duration(self, start, dest, mode, departure_hour=9):
+        route = self.calculate_route(start, dest, mode, departure_hour)
+        return route['duration'], route['distance']
+
+    def calculate_distance_matrix(self, origins, destinations, mode, departure_hour=9):
+        departure_time = self.get_departure_time(departure_hour)
+        try:
+            with self.lock:
+                self.distance_matrix_api_calls = self.distance_matrix_api_calls + 1
+                if (self.distance_matrix_api_calls % 30 == 0):
+                    logger.debug('save cache...')
+                    self.save_cache()
+                logger.debug("number of distance matrix api calls: %d", self.distance_matrix_api_calls)
+            profiler.count('api.distance_matrix')
+            profiler.count('api.distance_matrix.elements', len(origins) * len(destinations))
+            with profiler.timed('api.distance_matrix'):
+                matrix_result = self.gmaps.distance_matrix(
+                    origins, destinations, mode=mode, departure_time=departure_time)
+        except:
+            logger.error('google map distance matrix api error')
+            self.save_cache()
+            raise
+        results = {}
+        for start, row in zip(origins, matrix_result['rows']):
+            for dest, element in zip(destinations, row['elements']):
+                if element['status'] == 'OK':
+                    results[(start, dest)] = {
+                        'duration': self.second_to_minute(element['duration']['value']),
+                        'distance': self.meter_to_mile(element['distance']['value']),
+                        'polyline_length': None,
+                        }
+                else:
+                    results[(start, dest)] = \
+                        {'duration': math.inf, 'distance': math.inf, 'polyline_length': None}
+        return results
+
+    def plan_distance_matrices(self, pairs):
+        # group origins asking for the same destinations, then cut every
+        # group into requests that stay within the distance matrix limits
+        dests_by_start = {}
+        for start, dest in pairs:
+            dests_by_start.setdefault(start, set()).add(dest)
+        starts_by_dests = {}
+        for start, dests in dests_by_start.items():
+            starts_by_dests.setdefault(tuple(sorted(dests)), []).append(start)
+        requests = []
+        for dests, starts in starts_by_dests.items():
+            for i in range(0, len(dests), self.max_matrix_destinations):
+                dest_chunk = list(dests[i:i + self.max_matrix_destinations])
+                rows = min(self.max_matrix_origins,
+                    self.max_matrix_elements // len(dest_chunk))
+                for j in range(0, len(starts), rows):
+                    requests.append((starts[j:j + rows], dest_chunk))
+        return requests
+
+    def fetch_distance_matrix(self, origins, destinations, mode, departure_hour):
+        results = self.calculate_distance_matrix(origins, destinations, mode, departure_hour)
+        for (start, dest), route in results.items():
+            self.cache.put(start, dest, mode, departure_hour, route)
+
+    def route(self, start, dest, mode="walking", departure_hour=9, count=True):
+        # the one memoized routing lookup: the cached entry with duration
+        # (min), distance (mile), polyline_length and fetched_at, only asking
+        # the directions api when the pair is not cached yet. count=False
+        # reads a route prefetch_routes already looked up.
+        entry = self.cache.get(start, dest, mode, departure_hour, count)
+        if entry is None:
+            entry = self.cache.put(start, dest, mode, departure_hour,
+                self.calculate_route(start, dest, mode, departure_hour))
+        return entry
+
+    def prefetch_distances_and_durations(self, pairs, mode="walking", departure_hour=9, matrix=True):
+        self.prefetch_routes([(start, dest, mode, departure_hour) for start, dest in pairs], matrix)
+
+    def prefetch_routes(self, routes, matrix=True):
+        # runs the uncached (start, dest, mode, departure_hour) lookups
+        # concurrently on the lookup pool, either as distance matrix requests
+        # (one mode and departure time each) or as one directions call per route
+        pending = {}
+        for start, dest, mode, departure_hour in set(routes):
+            if self.cache.get(start, dest, mode, departure_hour) is None:
+                pending.setdefault((mode, departure_hour), set()).add((start, dest))
+        if not pending:
+            return
+        calls = []
+        for (mode, departure_hour), pairs in sorted(pending.items()):
+            if matrix:
+                requests = self.plan_distance_matrices(pairs)
+                logger.info('fetching %d %s routes at %d:00 with %d distance matrix requests...',
+                    len(pairs), mode, departure_hour, len(requests))
+                calls.extend((('matrix', tuple(origins), tuple(destinations), mode, departure_hour),
+                    self.fetch_distance_matrix, (origins, destinations, mode, departure_hour))
+                    for origins, destinations in requests)
+            else:
+                logger.info('fetching %d %s routes at %d:00 with directions requests...',
+                    len(pairs), mode, departure_hour)
+                calls.extend((('directions', start, dest, mode, departure_hour),
+                    self.route, (start, dest, mode, departure_hour, False))
+                    for start, dest in sorted(pairs))
+        self.pool.run(calls)
+
+    def prefetch_approx_stations_with_shortest_time(self, addresses, max_station_considered=3, matrix=True):
+        # geocoded first, so that the spellings of a building share one entry
+        addresses = list(set(addresses))
+        self.get_geocodes(addresses)
+        pending = {}
+        for start in addresses:
+            key = self.station_key(start)
+            if key not in pending:
+                cached = self.cached_station(start) is not None
+                self.count_lookup('station', key, cached)
+                if not cached:
+                    pending[key] = start
+        addresses = list(pending.values())
+        geocodes = [geocode if is_geocode(geocode) else (math.nan, math.nan)
+            for geocode in map(self.cached_geocode, addresses)]
+        miles, indices = self.station_index.nearest_many(
+            [geocode[0] for geocode in geocodes], [geocode[1] for geocode in geocodes],
+            max_station_considered)
+        candidates = {}
+        for start, nearest in zip(addresses, indices):
+            candidates[start] = [self.stations[index] for index in nearest if index >= 0]
+        self.prefetch_distances_and_durations(
+            [(start, station) for start, stations in candidates.items() for station in stations],
+            "walking", 9, matrix)
+        for start, stations in candidates.items():
+            min_duration = math.inf
+            best_station = ""
+            for station in stations:
+                duration = self.route(start, station, "walking", count=False)['duration']
+                if (duration < min_duration):
+                    min_duration = duration
+                    best_station = station
+            with self.lock:
+                self.cache_smallest_station[self.station_key(start)] = {
+                    'min_duration': min_duration,
+                    'best_station': best_station,
+                    }
+
+    def estimate_lower_bounds(self, addresses):
+        # offline lower bounds of distance_to_fb (walking miles to loc) and
+        # time_to_shuttle (walking minutes to the closest station) from the
+        # geocodes alone, rows without a geocode get 0 and inf like the
+        # exact calculation
+        geocodes = [geocode if is_geocode(geocode) else (math.nan, math.nan)
+            for geocode in self.get_geocodes(addresses)]
+        lats = [geocode[0] for geocode in geocodes]
+        lngs = [geocode[1] for geocode in geocodes]
+        loc_geocode = self.get_geocode(self.loc)
+        if is_geocode(loc_geocode):
+            distances = haversine_miles_many(lats, lngs, loc_geocode) * self.detour_factor
         else:
-            return self.second_to_minute(directions_result[0]['legs'][0]['duration']['value']), \
-                self.meter_to_mile(directions_result[0]['legs'][0]['distance']['value'])
+            distances = np.full(len(addresses), np.nan)
+        station_miles, _ = self.station_index.nearest_many(lats, lngs, 1)
+        return pd.DataFrame({
+            'distance_to_fb': np.nan_to_num(distances, nan=0.0),
+            'time_to_shuttle': station_miles[:, 0] * self.detour_factor / self.max_walking_mph * 60,
+            }, index=list(addresses))
 
     def meter_to_mile(self, meters):
         return meters * 0.000621371
@@ -97,25 +313,8 @@ class DistanceCalculator:
             mode="walking",
             departure_hour=9,
             distances=True):
-        departure_time = datetime(
-            self.departure_time.year,
-            self.departure_time.month,
-            self.departure_time.day,
-            departure_hour)
-        key = start + dest + mode + str(departure_hour)
-        if key in self.cache:
-            return self.cache[key]['distance']
-        else:
-            duration, distance = self.calculate_distance_and_duration(
-                start, dest, mode, departure_hour)
-            if distances:
-                print("adding distance from {} to {}: distance = {} mile"\
-                    .format(start, dest, distance))
-            else:
-                print("adding duration from {} to {}: duration = {} min"\
-                    .format(start, dest, duration))
-            self.cache[key] = {'distance': distance, 'duration': duration}
-            return distance if distances else duration
+        entry = self.route(start, dest, mode, departure_hour)
+        return entry['distance'] if distances else entry['duration']
 
     def calculate_distances_or_durations_to_dest(
             self,
@@ -138,61 +337,132 @@ class DistanceCalculator:
     def find_station_with_shortest_time(self, start, stations=None):
         if not stations:
             stations = self.stations
-        key = start
+        key = self.station_key(start)
         min_duration = math.inf
         best_station = ""
-        if key in self.cache_smallest_station:
-            return dict([('time_to_shuttle', self.cache_smallest_station[key]['min_duration']), \
-                ('best_station', self.cache_smallest_station[key]['best_station'])])
+        cached = self.cached_station(start)
+        self.count_lookup('station', key, cached is not None)
+        if cached is not None:
+            return dict([('time_to_shuttle', cached['min_duration']), \
+                ('best_station', cached['best_station'])])
         else:
-            print('processing shortest station for {}...'.format(start))
+            logger.debug('processing shortest station for %s...', start)
             for station in stations:
-                duration, distance = self.calculate_distance_and_duration(
-                    start, station, "walking")
+                duration = self.route(start, station, "walking")['duration']
                 if (duration < min_duration):
                     min_duration = duration
                     best_station = station
-            print('adding the shuttle station for {}: min_duration = {}, best_station = {}'\
-                .format(start, min_duration, best_station))
-            self.cache_smallest_station[key] = {
-                'min_duration': min_duration,
-                'best_station': best_station,
-                }
+            logger.debug('adding the shuttle station for %s: min_duration = %s, best_station = %s',
+                start, min_duration, best_station)
+            with self.lock:
+                self.cache_smallest_station[key] = {
+                    'min_duration': min_duration,
+                    'best_station': best_station,
+                    }
             return {'time_to_shuttle': min_duration, 'best_station': best_station}
 
+    def cached_geocode(self, address):
+        # the geocode of address without an api call, None when it was never
+        # looked up. Geocodes are keyed on the canonical_address, the ones
+        # cached under a raw spelling by earlier versions are moved over.
+        # Coordinates in the address are their own geocode.
+        coordinates = parse_coordinates(address)
+        if coordinates is not None:
+            return coordinates
+        key = canonical_address(address)
+        if key not in self.cache_geo_code and address in self.cache_geo_code:
+            with self.lock:
+                self.cache_geo_code[key] = self.cache_geo_code[address]
+        return self.cache_geo_code.get(key)
+
+    def location_of(self, address):
+        # the rounded coordinates the caches key address on, None while its
+        # geocode is unknown
+        if address not in self.locations:
+            geocode = self.cached_geocode(address)
+            if not is_geocode(geocode):
+                return None
+            self.locations[address] = location_key(geocode, self.route_key_digits)
+        return self.locations[address]
+
+    def station_key(self, start):
+        return self.location_of(start) or canonical_address(start)
+
+    def cached_station(self, start):
+        # the closest shuttle station entry of start, None when it was never
+        # calculated. Entries written before the keys were canonical are
+        # moved over.
+        key = self.station_key(start)
+        if key not in self.cache_smallest_station:
+            for old_key in (canonical_address(start), start):
+                if old_key in self.cache_smallest_station:
+                    with self.lock:
+                        self.cache_smallest_station[key] = self.cache_smallest_station[old_key]
+                    break
+        return self.cache_smallest_station.get(key)
+
+    def count_lookup(self, cache, key, hit):
+        # one profiler hit or miss per key and run, the reads of an entry
+        # that was just looked up or filled are not lookups of their own
+        with self.lock:
+            if key in self.counted[cache]:
+                return
+            self.counted[cache].add(key)
+        profiler.hit(cache, hit)
+
     def get_geocode(self, address):
-        if address in self.cache_geo_code :
-            return self.cache_geo_code [address]
+        cached = self.cached_geocode(address)
+        if parse_coordinates(address) is None:
+            self.count_lookup('geocode', canonical_address(address), cached is not None)
+        if cached is not None:
+            return cached
         else:
             try:
-                self.geocode_api_calls = self.geocode_api_calls + 1
-                print("number of geocode api cals: {}".format(self.geocode_api_calls))
-                geocode = self.gmaps.geocode(address)
+                with self.lock:
+                    self.geocode_api_calls = self.geocode_api_calls + 1
+                    logger.debug("number of geocode api calls: %d", self.geocode_api_calls)
+                profiler.count('api.geocode')
+                with profiler.timed('api.geocode'):
+                    geocode = self.gmaps.geocode(address)
                 if geocode and 'geometry' in geocode[0] and  'location' in geocode[0]['geometry']:
                     geocode = (geocode[0]['geometry']['location']['lat'], geocode[0]['geometry']['location']['lng'])
-                self.cache_geo_code[address] = geocode
+                with self.lock:
+                    self.cache_geo_code[canonical_address(address)] = geocode
                 return geocode
             except:
-                print('google map api error')
+                logger.error('google map geocode api error')
                 self.save_cache()
                 raise
 
-    def find_approx_station_with_shortest_time(self, start, max_station_considered=3):
-        if start in self.cache_smallest_station:
-            return {'time_to_shuttle': self.cache_smallest_station[start]['min_duration'], \
-                'best_station': self.cache_smallest_station[start]['best_station']}
+    def get_geocodes(self, addresses):
+        # one api call per canonical address
+        keys = [canonical_address(address) for address in addresses]
+        pending = {}
+        for address, key in zip(addresses, keys):
+            if key not in pending and self.cached_geocode(address) is None:
+                pending[key] = address
+            elif parse_coordinates(address) is None:
+                self.count_lookup('geocode', key, key not in pending)
+        self.pool.map(self.get_geocode, [(address,) for address in pending.values()],
+            keys=[('geocode', key) for key in pending])
+        return [self.cached_geocode(address) for address in addresses]
+
+    def find_approx_stations(self, start, max_station_considered=3):
+        # the max_station_considered stations closest to start as the crow flies
         start_geocode = self.get_geocode(start)
-        print('Calcuating approximate shortest path for {}...'.format(start))
-        print(start_geocode)
-        print(self.stations_geocode[0])
-        stations_considered = []
-        for index, station_geocode in enumerate(self.stations_geocode):
-            dist = (start_geocode[0] - station_geocode[0])**2 + (start_geocode[1] - station_geocode[1])**2
-            if len(stations_considered) < max_station_considered:
-                stations_considered.append((dist, self.stations[index]))
-            else:
-                stations_considered.sort()
-                stations_considered[-1] = (dist, self.stations[index])
+        if not is_geocode(start_geocode):
+            return []
+        return [self.stations[index] for miles, index in
+            self.station_index.nearest(start_geocode, max_station_considered)]
 
-        stations = [x[1] for x in stations_considered]
+    def find_approx_station_with_shortest_time(self, start, max_station_considered=3):
+        cached = self.cached_station(start)
+        self.count_lookup('station', self.station_key(start), cached is not None)
+        if cached is not None:
+            return {'time_to_shuttle': cached['min_duration'], \
+                'best_station': cached['best_station']}
+        stations = self.find_approx_stations(start, max_station_considered)
+        if not stations:
+            logger.warning('no geocode for %s, skipping shuttle stations...', start)
+            return {'time_to_shuttle': math.inf, 'best_station': ""}
         return self.find_station_with_shortest_time(start, stations)
@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+
+_stop = object()
+
+
+class EnrichmentQueue:
+    # Producer/consumer hand-off between the crawl and the routing caches.
+    # The crawl pipeline puts every address it sees, background workers take
+    # them in batches and call enrich(addresses), which fills the
+    # DistanceCalculator caches while the crawl goes on. put() blocks while
+    # max_pending addresses are waiting, which slows the crawl down to the
+    # pace of the api instead of queueing without bound. The crawl pipeline
+    # tries put(address, block=False) first and only waits off the reactor
+    # thread.
+    def __init__(self, enrich, workers=2, batch_size=25, max_pending=1000, batch_wait=1.0):
+        self.enrich = enrich
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.enriched = 0
+        self.errors = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, address, block=True):
+        # returns False, without queueing the address, when block is False
+        # and max_pending addresses are waiting
+        if not address:
+            return True
+        with self.lock:
+            if self.closed or address in self.seen:
+                return True
+            self.seen.add(address)
+        try:
+            self.pending.put(address, block)
+        except queue.Full:
+            with self.lock:
+                self.seen.discard(address)
+            return False
+        return True
+
+    def next_batch(self):
+        # blocks for the first address, then waits up to batch_wait for more
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while batch[-1] is not _stop and len(batch) < self.batch_size:
+            try:
+                batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            stop = batch[-1] is _stop
+            addresses = [address for address in batch if address is not _stop]
+            if addresses:
+                try:
+                    self.enrich(addresses)
+                    with self.lock:
+                        self.enriched = self.enriched + len(addresses)
+                except Exception as exception:
+                    # the rows are routed again by preprocess_data after the crawl
+                    print('enrichment of {} addresses failed: {!r}'.format(len(addresses), exception))
+                    with self.lock:
+                        self.errors = self.errors + 1
+            for _ in batch:
+                self.pending.task_done()
+            if stop:
+                return
+
+    def close(self):
+        # lets the workers finish every queued address, then stops them
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for _ in self.threads:
+            self.pending.put(_stop)
+        for thread in self.threads:
+            thread.join()
+        print('enriched {} addresses during the crawl, {} failed batches'.format(
+            self.enriched, self.errors))
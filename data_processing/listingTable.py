@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import sys
+
+# the columns every unit of a property page shares, kept once per property
+property_columns = ['url', 'name', 'address', 'phone', 'feature_list']
+
+# nullable dtypes of the per unit columns, a missing value is <NA> instead of
+# NaN in a float64 column or an inf rent
+unit_dtypes = {
+    'bedroom_num': 'Int8',
+    'bathroom_num': 'Float32',
+    'sqrt_foot': 'Int32',
+    'min_rent': 'Int32',
+    'max_rent': 'Int32',
+}
+
+
+def compact_units(units):
+    for column, dtype in unit_dtypes.items():
+        if column in units.columns:
+            values = pd.to_numeric(units[column], errors='coerce')\
+                .astype('float64').replace([np.inf, -np.inf], np.nan)
+            if dtype.startswith('Int'):
+                values = values.round()
+            units[column] = values.astype(dtype)
+    # a missing date is NaT, not date.max
+    if 'avail_date' in units.columns:
+        units['avail_date'] = pd.to_datetime(units['avail_date'], errors='coerce')
+    if 'unit' in units.columns:
+        units['unit'] = units['unit'].astype('category')
+    units['property_id'] = units['property_id'].astype('int32')
+    return units
+
+
+class ListingTable:
+    # The crawl output as a property table, one row per property page
+    # indexed by its property_id, and a unit table with one row per unit
+    # and the property_id of its page. The spider repeats name, address,
+    # phone, url and the whole feature list for every unit, here they are
+    # stored once, the feature strings are interned across properties.
+    # The columns derived from the address (commutes, best_station, the
+    # feature flags) are added to the property table by preprocess_data.
+    def __init__(self, properties, units):
+        self.properties = properties
+        self.units = units
+
+    @classmethod
+    def from_items(cls, items):
+        property_ids = {}
+        properties = []
+        units = []
+        for item in items:
+            url = item.get('url')
+            if url not in property_ids:
+                property_ids[url] = len(properties)
+                row = dict((column, item.get(column)) for column in property_columns)
+                row['feature_list'] = [sys.intern(str(feature))
+                    for feature in row['feature_list'] or []]
+                properties.append(row)
+            unit = dict((k, v) for (k, v) in item.items() if k not in property_columns)
+            unit['property_id'] = property_ids[url]
+            units.append(unit)
+        return cls(pd.DataFrame(properties, columns=property_columns),
+            compact_units(pd.DataFrame(units, columns=None if units else ['property_id'])))
+
+    def memory_usage(self):
+        return int(self.properties.memory_usage(deep=True).sum()
+            + self.units.memory_usage(deep=True).sum())
+
+    def frame(self):
+        # one row per unit with the property columns joined on, for the
+        # query engine. Property strings become categoricals whose codes
+        # index the distinct values, the feature lists stay in the
+        # property table (see with_features).
+        ids = self.units['property_id'].to_numpy()
+        data = self.units.copy()
+        for column in self.properties.columns:
+            if column == 'feature_list':
+                continue
+            values = self.properties[column]
+            if pd.api.types.is_string_dtype(values.dtype):
+                codes, uniques = pd.factorize(values)
+                data[column] = pd.Categorical.from_codes(codes[ids], uniques)
+            else:
+                data[column] = values.take(ids).set_axis(data.index)
+        return data
+
+    def property_mask(self, mask, data):
+        # a mask over the properties as a mask over the rows of frame()
+        return np.asarray(mask)[data['property_id'].to_numpy()]
+
+    def with_features(self, data):
+        # rows of frame() with the feature list of their property in place
+        # of the property_id, as the crawl output has it
+        features = self.properties['feature_list'].to_numpy()[data['property_id'].to_numpy()]
+        return data.drop(columns=['property_id']).assign(feature_list=[
+            list(feature_list) if feature_list is not None else [] for feature_list in features])
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # allows `rate` calls per second on average and bursts of `capacity`
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class LookupPool:
+    # runs blocking api lookups on a thread pool. Identical lookups that are
+    # still in flight share one future, every attempt takes a token from the
+    # bucket and transient errors are retried with exponential backoff.
+    def __init__(self, max_workers=8, qps=None, retries=3, backoff=0.5,
+            is_transient=None):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.bucket = TokenBucket(qps) if qps else None
+        self.retries = retries
+        self.backoff = backoff
+        self.is_transient = is_transient or (lambda exception: False)
+        self.in_flight = {}
+        self.lock = threading.RLock()
+
+    def call(self, fn, *args):
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                return fn(*args)
+            except Exception as exception:
+                if attempt >= self.retries or not self.is_transient(exception):
+                    raise
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+                logger.warning('transient error %r, retrying in %.1fs...', exception, delay)
+                time.sleep(delay)
+                attempt = attempt + 1
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self.call, fn, *args)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda done: self.forget(key, done))
+            return future
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def map(self, fn, args_list, keys=None):
+        if keys is None:
+            keys = [tuple(args) for args in args_list]
+        return self.run([(key, fn, args) for key, args in zip(keys, args_list)])
+
+    def run(self, calls):
+        # runs (key, fn, args) calls, returns the results in order, raising
+        # the first error after every lookup has finished so that finished
+        # results still reach the caches
+        futures = [self.submit(key, fn, *args) for key, fn, args in calls]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index = index + 1
+        self.counts[index] = self.counts[index] + 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        self.max = max(self.max, value)
+
+    def report(self):
+        labels = ['<={}'.format(bucket) for bucket in self.buckets] + ['>{}'.format(self.buckets[-1])]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'buckets': OrderedDict(zip(labels, self.counts)),
+        }
+
+
+class Profiler:
+    # Wall time per pipeline stage, counters, latency histograms and cache
+    # hit ratios, collected from every thread and written out by
+    # rank_apts --profile as a json report.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.caches = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] = stage['seconds'] + elapsed
+                stage['calls'] = stage['calls'] + 1
+
+    @contextmanager
+    def timed(self, name):
+        # counts a call and its latency, e.g. one api request
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def hit(self, cache, hit=True, n=1):
+        with self.lock:
+            counts = self.caches.setdefault(cache, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] = counts['hits' if hit else 'misses'] + n
+
+    def record_cache(self, cache, stats):
+        # stats with hits and misses kept by the cache itself, e.g. RouteCache.stats()
+        with self.lock:
+            self.caches[cache] = dict(stats)
+
+    def report(self):
+        with self.lock:
+            caches = OrderedDict()
+            for name, counts in self.caches.items():
+                lookups = counts['hits'] + counts['misses']
+                caches[name] = dict(counts, hit_ratio=counts['hits'] / lookups if lookups else None)
+            return {
+                'started': self.started,
+                'wall_seconds': time.time() - self.started,
+                'stages': OrderedDict((name, dict(stage)) for name, stage in self.stages.items()),
+                'counters': OrderedDict(self.counters),
+                'latency': OrderedDict((name, histogram.report())
+                    for name, histogram in self.histograms.items()),
+                'caches': caches,
+            }
+
+    def write(self, path, extra=None):
+        report = self.report()
+        report.update(extra or {})
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+# the process wide profiler the data processing modules report to
+profiler = Profiler()
@@ -0,0 +1,119 @@
+from amenityIndex import AmenityIndex
+import numpy as np
+import warnings
+
+# boolean columns precomputed at preprocessing time from feature_list, each
+# is an amenity query matched on whole words: 'washer' finds "Washer/Dryer"
+# but not "Dishwasher"
+feature_flags = {
+    'has_washer_dryer': 'washer',
+    'has_ac': '"air c"',
+}
+
+comparisons = {
+    '>=': lambda values, value: values >= value,
+    '<=': lambda values, value: values <= value,
+    '==': lambda values, value: values == value,
+    'is': lambda values, value: values.astype(bool) == value,
+}
+
+
+def add_feature_flags(data, amenity_index=None):
+    # amenity_index is the index of data's feature lists, built when missing
+    amenity_index = amenity_index or AmenityIndex(data['feature_list'])
+    for column, query in feature_flags.items():
+        data[column] = amenity_index.query(query)
+    return data
+
+
+def build_mask(data, predicates, mask=None):
+    # ANDs every (column, op, value) predicate into one boolean mask, rows
+    # where a value is missing never match. mask can carry a precomputed
+    # selection such as the result of an amenity query.
+    mask = np.ones(data.shape[0], dtype=bool) if mask is None else mask.copy()
+    for column, op, value in predicates:
+        matches = comparisons[op](data[column], value)
+        mask &= matches.to_numpy(dtype=bool, na_value=False)
+    return mask
+
+
+def smallest_k(values, k=None):
+    # positions of the k smallest values in order, found with a partial
+    # sort. Missing values go last.
+    if k is None or k > len(values):
+        k = len(values)
+    if k <= 0:
+        return np.array([], dtype=int)
+    if k < len(values):
+        selected = np.argpartition(values, k - 1)[:k]
+    else:
+        selected = np.arange(len(values))
+    return selected[np.argsort(values[selected], kind='stable')]
+
+
+def top_k(data, mask, k=None, column='min_rent'):
+    # the k matching rows with the smallest column values in order
+    rows = np.flatnonzero(mask)
+    values = data[column].to_numpy(dtype=float, na_value=np.nan)[rows]
+    return data.iloc[rows[smallest_k(values, k)]]
+
+
+# columns where more is better, every other ranking column is a cost
+higher_is_better = {'sqrt_foot', 'bedroom_num', 'bathroom_num'}
+
+
+def normalize(values, method='minmax'):
+    # scales every column of values to a cost where 0 is the best value
+    # among the rows, 'minmax' to [0, 1] and 'zscore' to standard deviations
+    # from the mean. Missing and infinite values get the worst finite cost.
+    values = np.where(np.isfinite(values), values, np.nan)
+    with warnings.catch_warnings():
+        # columns without any value
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'zscore':
+            center = np.nanmean(values, axis=0)
+            scale = np.nanstd(values, axis=0)
+        elif method == 'minmax':
+            center = np.nanmin(values, axis=0)
+            scale = np.nanmax(values, axis=0) - center
+        else:
+            raise ValueError('unknown normalization {}'.format(method))
+        scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        costs = (values - np.nan_to_num(center)) / scale
+        worst = np.nanmax(costs, axis=0) if len(costs) else 0
+    return np.where(np.isnan(costs), np.nan_to_num(worst), costs)
+
+
+class Ranker:
+    # Scores the matching rows as a weighted sum of their normalized
+    # ranking columns, the lower the better. The normalized matrix is built
+    # once, so sweeping weight profiles costs one matrix-vector product and
+    # a partial sort each.
+    def __init__(self, data, mask, columns, normalization='minmax'):
+        self.data = data
+        self.rows = np.flatnonzero(mask)
+        self.columns = list(columns)
+        values = np.column_stack([data[column].to_numpy(dtype=float, na_value=np.nan)[self.rows]
+            for column in self.columns]) if self.columns else np.empty((len(self.rows), 0))
+        # more is better columns are flipped into costs first
+        signs = np.array([-1.0 if column in higher_is_better else 1.0 for column in self.columns])
+        self.costs = normalize(values * signs, normalization) if len(self.rows) else values
+
+    def scores(self, weights):
+        return self.costs @ np.array([weights.get(column, 0.0) for column in self.columns])
+
+    def top_k(self, weights, k=None):
+        # the k best rows in order with their score
+        scores = self.scores(weights)
+        selected = smallest_k(scores, k)
+        return self.data.iloc[self.rows[selected]].assign(score=scores[selected])
+
+
+def run_query(data, predicates, k=None, column='min_rent', mask=None, weights=None,
+        normalization='minmax'):
+    # with weights ({column: weight}) the rows are ranked by their weighted
+    # score instead of by column
+    mask = build_mask(data, predicates, mask)
+    if weights:
+        return Ranker(data, mask, list(weights), normalization).top_k(weights, k)
+    return top_k(data, mask, k, column)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+import config
+from distanceCalculator import DistanceCalculator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from os.path import getmtime, isfile
+from queryEngine import run_query
+import rank_apts
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger(__name__)
+
+# query string parameters that map to rank_apts filter options
+filter_parameters = ['bed', 'bath', 'walk', 'price', 'dist', 'avail_before', 'avail_after']
+
+
+class Dataset:
+    # The preprocessed listings with their amenity index, swapped as a whole
+    # on reload so that a query always sees one consistent version.
+    def __init__(self, listings, mtime):
+        self.listings = listings
+        self.data = listings.frame()
+        self.mtime = mtime
+        self.loaded_at = time.time()
+        self.amenity_index = rank_apts.load_amenity_index(listings.properties['feature_list'])
+        self.amenity_masks = OrderedDict()
+        self.max_amenity_masks = getattr(config, 'amenity_mask_cache_size', 256)
+        self.lock = threading.Lock()
+
+    def amenity_mask(self, query):
+        # queries repeat a lot, the masks of the most recently used
+        # max_amenity_masks queries are kept per dataset
+        with self.lock:
+            mask = self.amenity_masks.get(query)
+            if mask is not None:
+                self.amenity_masks.move_to_end(query)
+                return mask
+        mask = self.listings.property_mask(self.amenity_index.query(query), self.data)
+        with self.lock:
+            self.amenity_masks[query] = mask
+            while len(self.amenity_masks) > self.max_amenity_masks:
+                self.amenity_masks.popitem(last=False)
+        return mask
+
+
+class QueryServer:
+    # Keeps the preprocessed listings, the amenity index and the routing
+    # caches in memory and answers filter/rank queries against them. A
+    # watcher thread reloads when a new crawl output lands, preprocess_data
+    # only routes the listings that are new or changed.
+    def __init__(self, reload_interval=60):
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.reloading = threading.Lock()
+        self.distance_calc = None
+        self.dataset = None
+        self.queries = 0
+        self.reload()
+
+    def crawl_mtime(self):
+        # the feed lands when a crawl has finished, the listing store is
+        # still being written to while it runs
+        return getmtime(rank_apts.data_full_path) if isfile(rank_apts.data_full_path) else None
+
+    def reload(self, force=False):
+        # returns whether a new version was loaded
+        with self.reloading:
+            mtime = self.crawl_mtime()
+            if mtime is None or (not force and self.dataset and self.dataset.mtime == mtime):
+                return False
+            started = time.perf_counter()
+            if self.distance_calc is None:
+                self.distance_calc = DistanceCalculator()
+            listings = rank_apts.load_listing_data()
+            listings.properties = rank_apts.preprocess_data(listings.properties,
+                distance_calc=self.distance_calc)
+            dataset = Dataset(listings, mtime)
+            with self.lock:
+                self.dataset = dataset
+            logger.info('loaded %d listings (%.1f MB) in %.2fs', dataset.data.shape[0],
+                listings.memory_usage() / 1e6, time.perf_counter() - started)
+            return True
+
+    def watch(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception('reload failed, still serving the previous data')
+
+    def query(self, parameters):
+        # parameters are the query string values, e.g. bed=2&walk=15&topk=10
+        # &amenity=washer AND dishwasher&weights=min_rent:1,time_to_fb_at_9:0.5
+        with self.lock:
+            dataset = self.dataset
+            self.queries = self.queries + 1
+        if dataset is None:
+            raise ValueError('no crawl output to serve yet')
+        opts = [('--' + k, v) for (k, v) in parameters if k in filter_parameters]
+        opts += [('-w', '') for (k, v) in parameters if k == 'w' and v != '0']
+        opts += [('-a', '') for (k, v) in parameters if k == 'a' and v != '0']
+        predicates = rank_apts.build_predicates(opts, logger.debug)
+        mask = None
+        for (k, v) in parameters:
+            if k == 'amenity':
+                amenity_mask = dataset.amenity_mask(v)
+                mask = amenity_mask if mask is None else mask & amenity_mask
+        values = dict(parameters)
+        topK = int(values['topk']) if 'topk' in values else None
+        weights = rank_apts.parse_weights(values['weights']) if 'weights' in values \
+            else getattr(config, 'ranking_weights', None)
+        unknown = [column for column in (weights or {}) if column not in dataset.data.columns]
+        if unknown:
+            raise ValueError('unknown ranking columns: {}'.format(', '.join(unknown)))
+        return dataset.listings.with_features(run_query(dataset.data, predicates, topK,
+            'min_rent', mask, weights, getattr(config, 'ranking_normalization', 'minmax')))
+
+    def stats(self):
+        with self.lock:
+            dataset = self.dataset
+            return {
+                'listings': dataset.data.shape[0] if dataset else 0,
+                'loaded_at': dataset.loaded_at if dataset else None,
+                'queries': self.queries,
+            }
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # GET /query?..., GET /stats and POST /reload
+    server_version = 'findApartment/1.0'
+
+    def send_json(self, status, body):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_json(200, self.server.query_server.stats())
+        if url.path != '/query':
+            return self.send_json(404, {'error': 'unknown path {}'.format(url.path)})
+        started = time.perf_counter()
+        try:
+            result = self.server.query_server.query(parse_qsl(url.query))
+        except (ValueError, KeyError) as exception:
+            return self.send_json(400, {'error': str(exception)})
+        self.send_json(200, result.to_json(orient='records', date_format='iso').encode('utf-8'))
+        logger.info('%s: %d rows in %.1fms', url.query, result.shape[0],
+            (time.perf_counter() - started) * 1000)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/reload':
+            return self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+        self.send_json(200, {'reloaded': self.server.query_server.reload(force=True)})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port=8765, reload_interval=60, host='127.0.0.1'):
+    query_server = QueryServer(reload_interval)
+    httpd = ThreadingHTTPServer((host, port), QueryHandler)
+    httpd.query_server = query_server
+    threading.Thread(target=query_server.watch, daemon=True).start()
+    return httpd
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print('usage: %s [--port=8765] [--host=127.0.0.1] [--reload_interval=seconds]' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], '', ['port=', 'host=', 'reload_interval='])
+    except getopt.GetoptError:
+        return usage()
+    opts = dict(opts)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    httpd = serve(int(opts.get('--port', 8765)), int(opts.get('--reload_interval', 60)),
+        opts.get('--host', '127.0.0.1'))
+    print('serving on http://{}:{}/query'.format(*httpd.server_address))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if httpd.query_server.distance_calc is not None:
+            httpd.query_server.distance_calc.save_cache()
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -1,215 +1,619 @@
 #!/usr/bin/env python
+from amenityIndex import AmenityIndex, feature_signature
+from canonicalAddress import canonical_address
+from commuteGrid import CommuteGrid
+from commuteMatrix import commute_specs, compute_commutes, prefetch_commutes
+import config
 from config import path_to_data, crawl_data_file, pre_processed_file, \
     crawl_command_dir, crawl_data_input_file
+from dataStore import frame_exists, load_frame, load_listing_table, remove_frame, save_frame
 from datetime import datetime
 from distanceCalculator import DistanceCalculator
+from enrichment import EnrichmentQueue
+from glob import glob
 import json
+import logging
 import os
 from os.path import isfile, join
 import pandas as pd
-from pandas.io.json import json_normalize
 from pprint import pprint
+from profiler import profiler
+from queryEngine import add_feature_flags, feature_flags, run_query
+from replay import replay_archives
+from shardedCrawl import import_project_module, run_sharded_crawl
+from stationIndex import is_geocode
 import sys
+import time
 
 data_full_path = join(path_to_data, crawl_data_file)
 pre_processed_full_path = join(path_to_data, pre_processed_file)
 crawl_data_input = join(path_to_data, crawl_data_input_file)
+crawl_delta_full_path = join(path_to_data, 'output.delta.json')
+fingerprints_full_path = join(path_to_data, 'fingerprints.sqlite')
+listings_full_path = join(path_to_data, 'listings.sqlite')
+commute_grid_full_path = join(path_to_data, 'commute_grid.npz')
+amenity_index_full_path = join(path_to_data, 'amenity_index.npz')
+parse_profile_full_path = join(path_to_data, 'parse_profile.json')
+response_archive_full_path = join(path_to_data, 'responses.gz')
 
 
-def filter_bed_room_number(num_bedroom, data):
-    return data[data['bedroom_num']>=num_bedroom]
+def build_predicates(opts, report=print):
+    # turns the filter options into (column, op, value) predicates for the
+    # query engine, which applies all of them in one pass. report gets a
+    # line per filter, the query server logs them at debug level.
+    predicates = []
+    for (k, v) in opts:
+        if k == '--bed':
+            report('filter out apts with < {} bedrooms...'.format(v))
+            predicates.append(('bedroom_num', '>=', int(v)))
+        elif k == '--bath':
+            report('filter out apts with < {} bathrooms...'.format(v))
+            predicates.append(('bathroom_num', '>=', int(v)))
+        elif k == '--walk':
+            report('filter out apts that are > {} min to reach from any shuttle station...'.format(v))
+            predicates.append(('time_to_shuttle', '<=', int(v)))
+        elif k == '--price':
+            report('filter out apts with min_rent > ${}...'.format(v))
+            predicates.append(('min_rent', '<=', int(v)))
+        elif k == '--dist':
+            report('filter out apts with distance more than {} miles from Facebook...'.format(v))
+            predicates.append(('distance_to_fb', '<=', int(v)))
+        elif k == '--avail_before':
+            report('save only apartments that are available before {}...'.format(v))
+            predicates.append(('avail_date', '<=', pd.Timestamp(v)))
+        elif k == '--avail_after':
+            report('save only apartments that are available after {}...'.format(v))
+            predicates.append(('avail_date', '>=', pd.Timestamp(v)))
+        elif k == '-w':
+            report('filter out apts with no washer/dryer...')
+            predicates.append(('has_washer_dryer', 'is', True))
+        elif k == '-a':
+            report('filter out apts with no air conditioner...')
+            predicates.append(('has_ac', 'is', True))
+    return predicates
+
+def parse_weights(value):
+    # --weights=min_rent:1,time_to_fb_at_9:0.5,sqrt_foot:0.2
+    weights = {}
+    for term in value.split(','):
+        column, _, weight = term.partition(':')
+        weights[column.strip()] = float(weight) if weight else 1.0
+    return weights
+
+def prefetch_routes(distance_calc, addresses, columns, matrix=True):
+    # fill the caches with concurrent (and by default batched distance
+    # matrix) requests so that the per row lookups below are cache hits
+    addresses = list(addresses.dropna().unique())
+    if 'time_to_shuttle' in columns:
+        distance_calc.prefetch_approx_stations_with_shortest_time(addresses, matrix=matrix)
+    prefetch_commutes(distance_calc, addresses,
+        [spec for spec in commutes if spec['name'] in columns], matrix)
+    distance_calc.save_cache()
+
+def enrich_during_crawl(distance_calc, addresses, limits=None, grid=False, batch=True):
+    # a batch of addresses from the enrichment queue. With --grid they are
+    # only geocoded, preprocess_data interpolates most of them on the grid.
+    # Otherwise they are routed, except the ones the limits prune.
+    addresses = pd.Series(addresses)
+    if grid:
+        distance_calc.get_geocodes(list(addresses))
+        distance_calc.save_cache()
+        return
+    if limits:
+        addresses.index = addresses.map(canonical_address)
+        addresses = addresses[~addresses.index.isin(
+            prune_by_lower_bounds(distance_calc, addresses, limits))]
+    prefetch_routes(distance_calc, addresses, extra_columns, batch)
+
+def crawl(output_path, spider_args, enrichment=None, crawl_settings=None, shards=1):
+    # runs the apartments spider from the scrapy project. With an
+    # enrichment queue the crawl runs in this process so that the item
+    # pipeline can hand every address to the queue while the crawl goes on.
+    # With shards > 1 the query areas are split across that many scrapy
+    # processes. crawl_settings are extra scrapy settings, paths are made
+    # absolute.
+    output_path = os.path.abspath(output_path)
+    spider_args = dict((k, os.path.abspath(v)) for (k, v) in spider_args.items())
+    crawl_settings = dict((k, os.path.abspath(v)) for (k, v) in (crawl_settings or {}).items())
+    if shards > 1 and enrichment is None:
+        input_path = spider_args.pop('input')
+        run_sharded_crawl(input_path, output_path, shards, os.path.abspath(crawl_command_dir),
+            spider_args, crawl_settings, os.path.abspath(listings_full_path))
+        return
+    if shards > 1:
+        print('--pipelined crawls run in this process, ignoring --shards')
+    crawl_settings['LISTINGS_STORE'] = os.path.abspath(listings_full_path)
+    cwd = os.getcwd()
+    os.chdir(crawl_command_dir)
+    try:
+        if enrichment is None:
+            os.system("scrapy crawl apartments -o {} {} {}".format(output_path,
+                ' '.join('-a {}={}'.format(k, v) for (k, v) in spider_args.items()),
+                ' '.join('-s {}={}'.format(k, v) for (k, v) in crawl_settings.items())))
+        else:
+            from scrapy.crawler import CrawlerProcess
+            from scrapy.utils.project import get_project_settings
+            settings = get_project_settings()
+            settings.set('FEEDS', {output_path: {'format': 'json'}})
+            for (k, v) in crawl_settings.items():
+                settings.set(k, v)
+            process = CrawlerProcess(settings)
+            # scrapy copies its settings, the queue goes in as a spider argument
+            process.crawl('apartments', enrichment=enrichment, **spider_args)
+            process.start()
+    finally:
+        os.chdir(cwd)
+
+# the derived columns are kept per property page
+property_key = ['url']
+
+def response_archives():
+    # the archive of an unsharded crawl and the ones of the shards
+    root, ext = os.path.splitext(response_archive_full_path)
+    return [path for path in [response_archive_full_path] + glob(root + '.*' + ext)
+        if isfile(path)]
+
+def remove_response_archives():
+    for path in response_archives():
+        os.remove(path)
+        if isfile(path + '.idx'):
+            os.remove(path + '.idx')
+
+def remove_listing_store():
+    # a full crawl or a replay rewrites every listing into a new store
+    for path in (listings_full_path, listings_full_path + '-wal', listings_full_path + '-shm'):
+        if isfile(path):
+            os.remove(path)
+
+def seed_listing_store():
+    # an incremental crawl only writes the changed units into the store, a
+    # feed crawled before the store existed is copied into it first
+    pipelines = import_project_module('pipelines')
+    with open(data_full_path) as apts_file:
+        items = [pipelines.normalize_item(item) for item in json.load(apts_file)]
+    store = pipelines.ListingStore(listings_full_path)
+    try:
+        store.write(items)
+    finally:
+        store.close()
+
+def load_listing_data():
+    # the typed parquet copy of the listing store the crawl pipeline streams
+    # into, rebuilt when the store changed. The feed is the source only for
+    # data crawled before the store existed.
+    return load_listing_table(data_full_path, listings_full_path)
+
+def forget_unseen_pages(since):
+    # the urls of the property pages the incremental crawl started at
+    # `since` reached, the fingerprints of the others are deleted: they
+    # left the search results. None when the crawl reached no page at all,
+    # e.g. without network, then nothing is dropped.
+    store = import_project_module('fingerprints').FingerprintStore(fingerprints_full_path)
+    try:
+        if not store.seen_since(since):
+            print('the crawl reached no property page, keeping every listing')
+            return None
+        return store.forget_unseen(since)
+    finally:
+        store.close()
+
+def merge_crawl_delta(since=None):
+    # an incremental crawl only emits new or changed units and a removed
+    # marker for units that are gone, apply them to the full crawl output.
+    # With the start time of the crawl, the units of the pages it did not
+    # reach are dropped as well, from the listing store too.
+    listings = {}
+    if isfile(data_full_path):
+        with open(data_full_path) as apts_file:
+            for item in json.load(apts_file):
+                listings[(item['url'], item['unit'])] = item
+    with open(crawl_delta_full_path) as delta_file:
+        delta = json.load(delta_file)
+    for item in delta:
+        key = (item['url'], item['unit'])
+        if item.get('removed'):
+            listings.pop(key, None)
+        else:
+            listings[key] = item
+    reached = forget_unseen_pages(since) if since is not None else None
+    if reached is not None:
+        delisted = [key for key in listings if key[0] not in reached]
+        for key in delisted:
+            del listings[key]
+        print('dropped {} units of properties that left the search results'.format(len(delisted)))
+        if delisted and isfile(listings_full_path):
+            store = import_project_module('pipelines').ListingStore(listings_full_path)
+            try:
+                store.write([{'url': url, 'unit': unit, 'removed': True} for (url, unit) in delisted])
+            finally:
+                store.close()
+    print('merged {} changed units, {} listings in total'.format(len(delta), len(listings)))
+    tmp_path = data_full_path + '.tmp'
+    with open(tmp_path, 'w') as apts_file:
+        json.dump(list(listings.values()), apts_file)
+    os.replace(tmp_path, data_full_path)
 
-def filter_bath_room_number(num_bathroom, data):
-    return data[data['bathroom_num']>=num_bathroom]
+# the commute columns come from config.commutes / config.commute_matrix,
+# by default distance_to_fb, time_to_fb_at_9 and time_from_fb_at_18
+commutes = commute_specs()
+extra_columns = ['time_to_shuttle'] + [spec['name'] for spec in commutes]
 
-def filter_walking_min_to_station(minute, data):
-    print(data.columns)
-    if not data.empty:
-        return data[data['time_to_shuttle']<=minute]
+def enrich_addresses(distance_calc, addresses, columns):
+    # addresses maps a canonical address to one of its raw spellings,
+    # columns maps a derived column to the canonical addresses that need
+    # it. Returns a frame of the derived columns indexed by normalized
+    # address, the commutes are filled in from one float32 array.
+    keys = list(addresses.index)
+    enriched = pd.DataFrame(index=addresses.index, columns=extra_columns + ['best_station'])
+    if 'time_to_shuttle' in columns:
+        with profiler.stage('preprocess.time_to_shuttle'):
+            shuttle = [distance_calc.find_approx_station_with_shortest_time(address)
+                if key in columns['time_to_shuttle'] else {}
+                for key, address in addresses.items()]
+        enriched['time_to_shuttle'] = [row.get('time_to_shuttle') for row in shuttle]
+        enriched['best_station'] = [row.get('best_station') for row in shuttle]
+    specs = [spec for spec in commutes if spec['name'] in columns]
+    with profiler.stage('preprocess.commutes'):
+        values = compute_commutes(distance_calc, list(addresses), specs,
+            lambda i, j: keys[i] in columns[specs[j]['name']])
+    for j, spec in enumerate(specs):
+        enriched[spec['name']] = values[:, j]
+    return enriched
 
-def filter_apt_price(price, data):
-    return data[data['min_rent']<=price]
+def load_pre_processed(columns=None):
+    if frame_exists(pre_processed_full_path):
+        return load_frame(pre_processed_full_path, columns)
+    return None
 
-def filter_distance_to_fb(distance, data):
-    return data[data['distance_to_fb']<=distance]
+def save_pre_processed(data):
+    save_frame(data, pre_processed_full_path)
 
-def has_similar_feature(desired_feature, featureList):
-    for feature in strList:
-        if desired_feature in feature.lower():
-            return True
-    return False
+def merge_pre_processed(data, stored):
+    # take the derived columns of properties whose address did not change
+    # since they were preprocessed, returns the merged data and a mask of the
+    # rows that need to be recalculated
+    derived_columns = [column for column in extra_columns + ['best_station', 'approximate']
+        if column in stored.columns]
+    stored = stored.drop_duplicates(property_key, keep='last')\
+        [property_key + ['address'] + derived_columns]\
+        .rename(columns={'address': 'pre_processed_address'})
+    data = data.drop(columns=[column for column in derived_columns if column in data.columns])\
+        .merge(stored, on=property_key, how='left')
+    stale = data['pre_processed_address'] != data['address']
+    if 'approximate' in data.columns:
+        data['approximate'] = data['approximate'].fillna(False).astype(bool)
+    return data.drop(columns=['pre_processed_address']), stale
 
-def filter_no_washer_dryer(data):
-    return data[data['feature_list'].apply(lambda x: has_similar_feature('washer', x))]
+# derived columns DistanceCalculator.estimate_lower_bounds can bound
+lower_bound_columns = ['distance_to_fb', 'time_to_shuttle']
 
-def filter_no_ac(data):
-    return data[data['feature_list'].apply(lambda x: has_similar_feature('air c', x))]
+def prune_by_lower_bounds(distance_calc, addresses, limits):
+    # canonical addresses whose offline lower bound already exceeds one of
+    # the limits ({column: max value}), they fail the filters whatever the
+    # exact routes are
+    bounds = distance_calc.estimate_lower_bounds(list(addresses))
+    over = pd.Series(False, index=bounds.index)
+    for column, limit in limits.items():
+        over |= bounds[column] > limit
+    return set(addresses.index[over.to_numpy()])
 
-def preprocess_data(data):
-    pre_processed_file_exist = isfile(pre_processed_full_path)
-    if pre_processed_file_exist:
-        data = pd.read_json(pre_processed_full_path, orient='records')
-    extra_columns = [
-        'time_to_shuttle',
-        'distance_to_fb',
-        'time_to_fb_at_9',
-        'time_from_fb_at_18'
-    ]
-    columns_exist = [
-        (column in data.columns) for column in extra_columns
-    ]
+def load_commute_grid(distance_calc, addresses, batch=True):
+    # the grid of the last run unless the columns or the step changed or it
+    # is older than commute_grid_max_age seconds (a week by default, like
+    # the driving times in the routing cache). Listings of a later crawl in
+    # cells the grid did not route are routed exactly.
+    step_miles = getattr(config, 'commute_grid_step_miles', 0.5)
+    max_age = getattr(config, 'commute_grid_max_age', 7 * 24 * 3600)
+    if isfile(commute_grid_full_path):
+        grid = CommuteGrid.load(commute_grid_full_path)
+        if grid.columns == extra_columns and grid.step_miles == step_miles \
+                and time.time() - grid.built_at <= max_age:
+            return grid
+    geocodes = [geocode for geocode in distance_calc.get_geocodes(list(addresses.dropna().unique()))
+        if is_geocode(geocode)]
+    if not geocodes:
+        return None
+    grid = CommuteGrid.build(distance_calc, geocodes, commutes, step_miles, matrix=batch,
+        max_nodes=getattr(config, 'commute_grid_max_nodes', 2000),
+        max_radius_miles=getattr(config, 'commute_grid_max_radius_miles', 50))
+    grid.save(commute_grid_full_path)
+    return grid
 
-    need_pre_processing = not all(columns_exist)
+def approximate_by_grid(distance_calc, grid, addresses, thresholds):
+    # grid estimates of the derived columns for the canonical addresses
+    # whose estimates are not within commute_grid_margin (relative) of one
+    # of the query thresholds ({column: [values]}), the others need exact
+    # routes. best_station becomes the closest station as the crow flies.
+    margin = getattr(config, 'commute_grid_margin', 0.25)
+    geocodes = [geocode if is_geocode(geocode) else (float('nan'), float('nan'))
+        for geocode in distance_calc.get_geocodes(list(addresses))]
+    lats = [geocode[0] for geocode in geocodes]
+    lngs = [geocode[1] for geocode in geocodes]
+    estimates = pd.DataFrame(grid.estimate(lats, lngs), index=addresses.index)
+    usable = estimates.notna().all(axis=1)
+    for column, values in thresholds.items():
+        for value in values:
+            usable &= (estimates[column] - value).abs() > margin * abs(value)
+    _, nearest = distance_calc.station_index.nearest_many(lats, lngs, 1)
+    estimates['best_station'] = [distance_calc.stations[index] if index >= 0 else ""
+        for index in nearest[:, 0]]
+    return estimates[usable]
+
+# the amenity index of the last feature lists, by their signature
+amenity_indexes = {}
+
+def load_amenity_index(feature_lists):
+    # the index saved with the preprocessed properties while their feature
+    # lists did not change, otherwise it is rebuilt and saved
+    signature = feature_signature(feature_lists)
+    if signature in amenity_indexes:
+        return amenity_indexes[signature]
+    amenity_index = None
+    if isfile(amenity_index_full_path):
+        amenity_index = AmenityIndex.load(amenity_index_full_path, feature_lists)
+        if amenity_index.signature != signature or amenity_index.size != len(feature_lists):
+            amenity_index = None
+    if amenity_index is None:
+        with profiler.stage('amenities'):
+            amenity_index = AmenityIndex(feature_lists)
+            # the phrases of the feature flags are saved with the index
+            for query in feature_flags.values():
+                amenity_index.query(query)
+        amenity_index.save(amenity_index_full_path)
+    amenity_indexes.clear()
+    amenity_indexes[signature] = amenity_index
+    return amenity_index
+
+def preprocess_data(data, batch=True, distance_calc=None, limits=None, grid=None, thresholds=None):
+    # data is the property table of a ListingTable, the derived columns are
+    # added to it. limits maps distance_to_fb / time_to_shuttle to the
+    # largest value the query accepts, properties that can't meet them are
+    # left unrouted. With a
+    # CommuteGrid the derived columns are interpolated on it and marked
+    # approximate, except near the thresholds ({column: [values]}) of the
+    # query. A later run without the grid routes the approximate rows.
+    data = data.reset_index(drop=True)
+    stale = pd.Series(True, index=data.index)
+    stored = load_pre_processed()
+    if stored is not None:
+        data, stale = merge_pre_processed(data, stored)
+    for column in extra_columns:
+        if column not in data.columns:
+            data[column] = float('nan')
+    if 'best_station' not in data.columns:
+        data['best_station'] = None
+    if 'approximate' not in data.columns:
+        data['approximate'] = False
+    # the commutes are kept as one compact float32 block
+    commute_columns = [spec['name'] for spec in commutes]
+    data[commute_columns] = data[commute_columns].astype('float32')
+
+    needs = dict((column, (stale | data['approximate'] | data[column].isna())
+        & data['address'].notna()) for column in extra_columns)
+    pending = pd.concat(list(needs.values()), axis=1).any(axis=1)
+    need_pre_processing = pending.any()
 
     if need_pre_processing:
-        distance_calc = DistanceCalculator()
-        if isfile(pre_processed_full_path):
-            os.remove(pre_processed_full_path)
-        for index, exists in enumerate(columns_exist):
-            if not exists:
-                column = extra_columns[index]
+        if distance_calc is None:
+            distance_calc = DistanceCalculator()
+        # properties can share a building, so every column is computed once
+        # per distinct canonical address and joined back onto the rows
+        keys = data['address'].map(canonical_address, na_action='ignore')
+        representatives = pd.Series(data.loc[pending, 'address'].to_numpy(),
+            index=keys[pending].to_numpy())
+        representatives = representatives[~representatives.index.duplicated()]
+        if limits:
+            # missing values never pass a filter, the pruned rows are routed
+            # by a later run without these limits
+            with profiler.stage('preprocess.prune'):
+                pruned_keys = prune_by_lower_bounds(distance_calc, representatives, limits)
+            pruned = pending & keys.isin(pruned_keys)
+            print('pruned {} properties at {} addresses that are too far for {}'.format(
+                pruned.sum(), len(pruned_keys), limits))
+            for column in extra_columns:
+                data.loc[needs[column] & pruned, column] = float('nan')
+                needs[column] = needs[column] & ~pruned
+            data.loc[pruned, 'best_station'] = None
+            pending = pending & ~pruned
+            representatives = representatives[~representatives.index.isin(pruned_keys)]
+        data.loc[pending, 'approximate'] = False
+        if grid is not None and len(representatives):
+            with profiler.stage('preprocess.grid'):
+                estimates = approximate_by_grid(distance_calc, grid, representatives, thresholds or {})
+            approximated = pending & keys.isin(estimates.index)
+            print('approximated {} properties at {} addresses on the commute grid'.format(
+                approximated.sum(), len(estimates)))
+            for column in extra_columns:
+                rows = needs[column] & approximated
+                data.loc[rows, column] = keys[rows].map(estimates[column]).astype(data[column].dtype)
                 if column == 'time_to_shuttle':
-                    try:
-                        print('calculating time_to_shuttle...')
-                        print(distance_calc.find_approx_station_with_shortest_time(data['address'][1]))
-                        data = data.merge(data['address'].apply(\
-                            lambda x: pd.Series(distance_calc.find_approx_station_with_shortest_time(x))),
-                            left_index=True,
-                            right_index=True)
-                        print('Finished calculatng time_to_shuttle. Save cache...')
-                        distance_calc.save_cache()
-                    except:
-                        print('Exception with time_to_shuttle calculation...')
-                        raise
-                elif column == 'distance_to_fb':
-                    try:
-                        print('calculating distance_to_fb...')
-                        data['distance_to_fb'] = \
-                            data['address'].apply(\
-                                lambda x: distance_calc.calculate_distances_or_durations_to_dest(x))
-                        print('Finished calculatng distance_to_fb. Save cache...')
-                        distance_calc.save_cache()
-                    except:
-                        print('Exception with distance_to_fb calculation...')
-                        raise
-                elif column == 'time_to_fb_at_9':
-                    try:
-                        print('calculating time_to_fb_at_9...')
-                        data['time_to_fb_at_9'] =\
-                            data['address'].apply(\
-                                lambda x: distance_calc.calculate_distances_or_durations_to_dest(\
-                                    x, "driving", 9, False))
-                        print('Finished calculatng time_to_fb_at_9. Save cache...')
-                        distance_calc.save_cache()
-                    except:
-                        print('Exception with time_to_fb_at_9 calculation...')
-                        raise
-                elif column == 'time_from_fb_at_18':
-                    try:
-                        print('calculating time_from_fb_at_18')
-                        data['time_from_fb_at_18'] =\
-                            data['address'].apply(\
-                                lambda x : distance_calc.calculate_distances_or_durations_from_dest(\
-                                    x, "driving", 18, False))
-                        print('Finished calculatng time_from_fb_at_18. Save cache...')
-                        distance_calc.save_cache()
-                    except:
-                        print('Exception with time_from_fb_at_18 calcuation...')
-                        raise
-            data.to_json(path_or_buf=pre_processed_full_path, orient='records')
+                    data.loc[rows, 'best_station'] = keys[rows].map(estimates['best_station'])
+                needs[column] = needs[column] & ~approximated
+            data.loc[approximated, 'approximate'] = True
+            pending = pending & ~approximated
+            representatives = representatives[~representatives.index.isin(estimates.index)]
+        columns = dict((column, set(keys[needs[column]])) for column in extra_columns
+            if needs[column].any())
+    if need_pre_processing and len(representatives):
+        print('prefetching routes...')
+        with profiler.stage('preprocess.prefetch'):
+            prefetch_routes(distance_calc, representatives, list(columns), matrix=batch)
+        print('calculating {} for {} distinct addresses of {} properties...'.format(
+            ', '.join(columns), len(representatives), pending.sum()))
+        try:
+            enriched = enrich_addresses(distance_calc, representatives, columns)
+        except:
+            print('Exception with route calculation...')
+            raise
+        finally:
+            distance_calc.save_cache()
+        for column in columns:
+            need = needs[column]
+            data.loc[need, column] = keys[need].map(enriched[column])
+            if column == 'time_to_shuttle':
+                data.loc[need, 'best_station'] = keys[need].map(enriched['best_station'])
+        print('routing cache: {}'.format(distance_calc.cache.stats()))
+    if distance_calc is not None:
+        profiler.record_cache('routes', distance_calc.cache.stats())
+    profiler.count('properties', data.shape[0])
+    profiler.count('properties.preprocessed', int(pending.sum()))
+    print('{} of {} properties needed preprocessing.'.format(pending.sum(), data.shape[0]))
+    # the -w / -a flags are amenity queries on the index --amenity uses
+    data = add_feature_flags(data, load_amenity_index(data['feature_list']))
+    save_pre_processed(data)
     return data
 
 # main
 def main(argv):
     import getopt
     def usage():
-        print ('usage: %s [--bed=min_bedroom] [--bath=min_bathroom] [--walk=min_walking_time] [--avail_before=date] [--avail_after=date] [--price=max_price] [--dist=distance][--topk=k] [-w] [-a] [--clean]' % argv[0])
+        print ('usage: %s [--bed=min_bedroom] [--bath=min_bathroom] [--walk=min_walking_time] [--avail_before=date] [--avail_after=date] [--price=max_price] [--dist=distance][--topk=k] [-w] [-a] [--amenity=query] [--clean] [--incremental] [--pipelined] [--grid] [--no_batch] [--profile=report.json] [--weights=column:weight,...] [--shards=n] [--archive] [--replay]' % argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'aw', ['bed=', 'bath=', 'walk=', 'price=', 'dist=', 'avail_before=', 'avail_after=', 'clean'])
+        (opts, args) = getopt.getopt(argv[1:], 'aw', ['bed=', 'bath=', 'walk=', 'price=', 'dist=', 'avail_before=', 'avail_after=', 'topk=', 'amenity=', 'clean', 'incremental', 'pipelined', 'grid', 'no_batch', 'profile=', 'weights=', 'shards=', 'archive', 'replay'])
     except getopt.GetoptError:
         return usage()
     # need arg to output data
     if not args: return usage()
 
     optsKeys = [k for (k, v) in opts]
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # --profile=report.json writes the stage times, api call counts and
+    # latencies, cache hit ratios and the crawl's parse times
+    profile_path = dict(opts).get('--profile')
+    crawl_settings = {}
+    if profile_path:
+        crawl_settings['PARSE_PROFILE'] = parse_profile_full_path
+        if isfile(parse_profile_full_path):
+            os.remove(parse_profile_full_path)
 
     if ('--clean' in optsKeys) and (isfile(data_full_path)):
         print("need to remove")
         os.remove(data_full_path)
-        if isfile(pre_processed_full_path):
-            os.remove(pre_processed_full_path)
+        remove_frame(pre_processed_full_path)
+        if isfile(amenity_index_full_path):
+            os.remove(amenity_index_full_path)
+        if isfile(fingerprints_full_path):
+            os.remove(fingerprints_full_path)
+        remove_listing_store()
+        if '--replay' not in optsKeys:
+            remove_response_archives()
+
+    # --archive keeps the raw pages of the crawl, a full crawl starts a new
+    # archive and an incremental one adds the changed pages to it
+    if '--archive' in optsKeys:
+        crawl_settings['RESPONSE_ARCHIVE'] = response_archive_full_path
 
-    if ('--clean' in optsKeys) or (not isfile(data_full_path)):
+    # --shards=n crawls the query areas in n scrapy processes
+    shards = int(dict(opts).get('--shards', 1))
+
+    predicates = build_predicates(opts)
+    # upper limits on the columns that have an offline lower bound
+    limits = dict((column, value) for (column, op, value) in predicates
+        if op == '<=' and column in lower_bound_columns)
+
+    # --pipelined routes the addresses while the crawl is still running
+    distance_calc = None
+    enrichment = None
+    if '--pipelined' in optsKeys:
+        distance_calc = DistanceCalculator()
+        enrichment = EnrichmentQueue(lambda addresses: enrich_during_crawl(distance_calc,
+            addresses, limits, '--grid' in optsKeys, '--no_batch' not in optsKeys))
+
+    if '--replay' in optsKeys:
+        # re-derive the crawl output from the archived pages, offline
+        archives = response_archives()
+        if not archives:
+            print('no archived responses in {}, crawl with --archive first'.format(path_to_data))
+            return usage()
+        remove_listing_store()
+        with profiler.stage('replay'):
+            replay_archives(archives, data_full_path, listings_path=listings_full_path)
+    elif ('--clean' in optsKeys) or (not isfile(data_full_path)):
         # recrawl data
         print("need to recrawl")
-        cwd = os.getcwd()
-        os.chdir(crawl_command_dir)
-        os.system("scrapy crawl apartments -o ./findApartment/data/output.json -a input={}".format(crawl_data_input))
-        os.chdir(cwd)
+        if '--archive' in optsKeys:
+            remove_response_archives()
+        remove_listing_store()
+        with profiler.stage('crawl'):
+            crawl(data_full_path, {'input': crawl_data_input}, enrichment, crawl_settings, shards)
+    elif '--incremental' in optsKeys:
+        # recrawl only what changed since the last crawl
+        print("recrawling changed apartments")
+        if isfile(crawl_delta_full_path):
+            os.remove(crawl_delta_full_path)
+        if not isfile(listings_full_path):
+            seed_listing_store()
+        crawl_started = time.time()
+        with profiler.stage('crawl'):
+            crawl(crawl_delta_full_path,
+                {'input': crawl_data_input, 'incremental': fingerprints_full_path},
+                enrichment, crawl_settings, shards)
+            merge_crawl_delta(crawl_started)
+    if enrichment is not None:
+        # no-op when the crawl pipeline already drained it
+        enrichment.close()
 
-    with open(data_full_path) as apts_file:
-       apts_info = json.load(apts_file)
-    apts_data = json_normalize(apts_info)
-    apts_data = preprocess_data(apts_data)
+    with profiler.stage('load'):
+        listings = load_listing_data()
+    print('loaded {} units of {} properties ({:.1f} MB)'.format(listings.units.shape[0],
+        listings.properties.shape[0], listings.memory_usage() / 1e6))
+    # --grid interpolates the commutes on a precomputed grid and only routes
+    # the properties close to the thresholds of the query
+    grid = None
+    thresholds = {}
+    if '--grid' in optsKeys:
+        distance_calc = distance_calc or DistanceCalculator()
+        with profiler.stage('grid'):
+            grid = load_commute_grid(distance_calc, listings.properties['address'],
+                '--no_batch' not in optsKeys)
+        for (column, op, value) in predicates:
+            if column in extra_columns:
+                thresholds.setdefault(column, []).append(value)
+    with profiler.stage('preprocess'):
+        listings.properties = preprocess_data(listings.properties,
+            batch=('--no_batch' not in optsKeys), distance_calc=distance_calc,
+            limits=limits, grid=grid, thresholds=thresholds)
+    apts_data = listings.frame()
 
     print('finished pre processing data.')
 
-    # sorting
-    print('sorting data...')
-    apts_data.sort_values(['min_rent'], inplace=True)
+    topK = None
+    for (k, v) in opts:
+        if k == '--topk':
+            # return only the best v apartments that pass the filters
+            topK = int(v)
 
-    topK = apts_data.shape[0]
+    # without weights the apartments are ranked by min_rent, with them by a
+    # weighted sum of the normalized columns
+    weights = getattr(config, 'ranking_weights', None)
+    if '--weights' in optsKeys:
+        weights = parse_weights(dict(opts)['--weights'])
+    if weights:
+        unknown = [column for column in weights if column not in apts_data.columns]
+        if unknown:
+            print('unknown ranking columns: {}'.format(', '.join(unknown)))
+            return usage()
+        print('ranking by {}...'.format(weights))
 
-    for (k, v) in opts:
-        if k == '--bed':
-            # filter out apts with < v bedrooms
-            print('filter out apts with < {} bedrooms...'.format(v))
-            apts_data = filter_bed_room_number(int(v), apts_data)
-            print('Done!')
-        elif k == '--bath':
-            # filter out apts with < v bathrooms
-            print('filter out apts with < {} bathrooms...'.format(v))
-            apts_data = filter_bath_room_number(int(v), apts_data)
-            print('Done!')
-        elif k == '--walk':
-            # filter out apts that are > v min to reach from any bus station
-            print('filter out apts that are > {} min to reach from any shuttle station...'.format(v))
-            apts_data = filter_walking_min_to_station(int(v), apts_data)
-            print('Done!')
-        elif k == '--price':
-            # filter out apts with min_rent > v
-            print('filter out apts with min_rent > ${}...'.format(v))
-            apts_data = filter_apt_price(int(v), apts_data)
-            print('Done!')
-        elif k == '--dist':
-            # filter out apts that are more than v miles from facebook
-            print('filter out apts with distance more than {} miles from Facebook...'.format(v))
-            apts_data = filter_distance_to_fb(int(v), apts_data)
-            print('Done!')
-        elif k == '--avail_before':
-            print('save only apartments that are available before {}...'.format(v))
-            apts_data = apts_data[apts_data['avail_date'] <= v]
-            print('Done!')
-        elif k == '--avail_after':
-            print('save only apartments that are available after {}...'.format(v))
-            apts_data = apts_data[apts_data['avail_date'] >= v]
-        elif k == '--topk':
-            # rank the apartments according to price and return the cheapest v of them
-            topK = k
-            # won't be appling cutoff here before all filtering are done
-        elif k == '-w':
-            # filter out apts with no washer/dryer
-            print('filter out apts with no washer/dryer...')
-            apts_data = filter_no_washer_dryer(apts_data)
-            print('Done!')
-        elif k == '-a':
-            # filter out apts with no air conditioner
-            print('filter out apts with no air conditioner...')
-            apts_data = filter_no_ac(apts_data)
-            print('Done!')
+    # e.g. --amenity="washer AND dishwasher AND NOT carpet", may be repeated
+    amenity_mask = None
+    amenity_queries = [v for (k, v) in opts if k == '--amenity']
+    if amenity_queries:
+        # the feature lists are indexed once per property by preprocess_data
+        amenity_index = load_amenity_index(listings.properties['feature_list'])
+        with profiler.stage('amenities'):
+            for query in amenity_queries:
+                print('save only apartments with {}...'.format(query))
+                mask = listings.property_mask(amenity_index.query(query), apts_data)
+                amenity_mask = mask if amenity_mask is None else amenity_mask & mask
 
-    apts_data = apts_data[:topK]
+    print('filtering and ranking data...')
+    with profiler.stage('filter'):
+        apts_data = run_query(apts_data, predicates, topK, 'min_rent', amenity_mask,
+            weights, getattr(config, 'ranking_normalization', 'minmax'))
+    print('Done!')
 
     fileName = join(path_to_data, args[0])
     if isfile(fileName):
@@ -217,8 +621,17 @@ def main(argv):
         os.remove(fileName)
 
     print('Saving result to {}...'.format(fileName))
-    with open(fileName, 'w') as output_file:
-        apts_data.to_csv(output_file)
+    with profiler.stage('write_csv'):
+        with open(fileName, 'w') as output_file:
+            listings.with_features(apts_data).to_csv(output_file)
     print('Done!')
 
+    if profile_path:
+        extra = {}
+        if isfile(parse_profile_full_path):
+            with open(parse_profile_full_path) as parse_file:
+                extra['crawl'] = json.load(parse_file)
+        profiler.write(profile_path, extra)
+        print('Wrote profile to {}'.format(profile_path))
+
 if __name__ == '__main__': sys.exit(main(sys.argv))
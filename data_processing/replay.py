@@ -0,0 +1,69 @@
+import json
+from multiprocessing import Pool
+import os
+from os.path import getmtime
+from shardedCrawl import import_project_module
+import time
+
+
+def replay_entries(task):
+    # runs the spider callbacks on the archived responses of one chunk and
+    # returns the items they yield, the requests they yield are dropped
+    # since every page the crawl fetched is in the archive itself
+    from scrapy.http import HtmlResponse, Request
+    archive_path, entries = task
+    archive = import_project_module('archive')
+    apartments = import_project_module('spiders.apartments')
+    pipelines = import_project_module('pipelines')
+    spider = apartments.ApartmentsSpider()
+    items = []
+    for header, body in archive.read_records(archive_path, entries):
+        callback = getattr(spider, header['callback'], None)
+        if callback is None:
+            continue
+        response = HtmlResponse(header['url'], status=header['status'], headers=header['headers'],
+            body=body, request=Request(header['url'], callback=callback))
+        for result in callback(response) or []:
+            if isinstance(result, dict):
+                items.append(pipelines.normalize_item(result))
+    return items
+
+
+def replay_archives(archive_paths, output_path, workers=None, chunk_size=100, listings_path=None):
+    # Re-derives the crawl output from the response archives without any
+    # network access, in parallel across `workers` processes (one per core
+    # by default). The latest archived response of every url is used, the
+    # items are deduplicated on (url, unit) like the crawl pipeline does and
+    # written into the listing store at listings_path as well.
+    archive = import_project_module('archive')
+    latest = {}
+    for path in sorted(archive_paths, key=getmtime):
+        for url, entry in archive.read_index(path).items():
+            latest[url] = (path, entry)
+    by_archive = {}
+    for path, entry in latest.values():
+        by_archive.setdefault(path, []).append(entry)
+    tasks = []
+    for path, entries in by_archive.items():
+        entries.sort()
+        tasks.extend((path, entries[i:i + chunk_size]) for i in range(0, len(entries), chunk_size))
+    print('replaying {} archived pages in {} chunks...'.format(len(latest), len(tasks)))
+    started = time.perf_counter()
+    with Pool(workers) as pool:
+        chunks = pool.map(replay_entries, tasks)
+    listings = {}
+    for items in chunks:
+        for item in items:
+            listings.setdefault((item['url'], item['unit']), item)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as output_file:
+        json.dump(list(listings.values()), output_file)
+    os.replace(tmp_path, output_path)
+    if listings_path:
+        store = import_project_module('pipelines').ListingStore(listings_path)
+        try:
+            store.write(list(listings.values()))
+        finally:
+            store.close()
+    print('replayed {} listings in {:.1f}s'.format(len(listings), time.perf_counter() - started))
+    return len(listings)
@@ -0,0 +1,112 @@
+from canonicalAddress import canonical_address
+from collections import OrderedDict
+import json
+import threading
+import time
+
+
+def normalize_address(address):
+    return ' '.join(address.split()).lower()
+
+
+class RouteCache:
+    # routing results keyed on (start, dest, mode, departure_hour). locate
+    # maps an address to its rounded coordinates (see location_key) when
+    # they are known, so that every spelling of a building shares its
+    # routes, other addresses are keyed on their canonical_address. Entries
+    # are written through to the persistent store and the most recently used
+    # max_entries of them stay in memory. ttl maps a mode to the seconds its
+    # results stay valid, modes that are not listed never expire.
+    def __init__(self, store, ttl=None, max_entries=100000, locate=None):
+        self.store = store
+        self.ttl = ttl or {}
+        self.max_entries = max_entries
+        self.locate = locate
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def place(self, address):
+        return (self.locate and self.locate(address)) or canonical_address(address)
+
+    def key(self, start, dest, mode, departure_hour):
+        return json.dumps([self.place(start), self.place(dest), mode, int(departure_hour)])
+
+    def old_keys(self, start, dest, mode, departure_hour):
+        # keys the entry may have been written under before the coordinates
+        # of one or both of its addresses were known, or by earlier versions
+        hour = int(departure_hour)
+        starts = [self.place(start)] + [canonical_address(start)]
+        dests = [self.place(dest)] + [canonical_address(dest)]
+        keys = [json.dumps([s, d, mode, hour]) for s in starts for d in dests]
+        keys += [
+            json.dumps([normalize_address(start), normalize_address(dest), mode, hour]),
+            start + dest + mode + str(departure_hour),
+        ]
+        return list(OrderedDict.fromkeys(keys))
+
+    def is_expired(self, entry, mode):
+        ttl = self.ttl.get(mode)
+        if ttl is None:
+            return False
+        fetched_at = entry.get('fetched_at')
+        return fetched_at is None or time.time() - fetched_at > ttl
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def get(self, start, dest, mode, departure_hour, count=True):
+        # count=False for re-reads that are not lookups of their own, e.g. of
+        # an entry a prefetch has just probed and filled
+        key = self.key(start, dest, mode, departure_hour)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.store.get(key)
+                if entry is None:
+                    for old_key in self.old_keys(start, dest, mode, departure_hour):
+                        entry = self.store.get(old_key) if old_key != key else None
+                        if entry is not None:
+                            self.store[key] = entry
+                            break
+            if entry is not None and self.is_expired(entry, mode):
+                self.entries.pop(key, None)
+                self.store.pop(key, None)
+                self.expirations = self.expirations + 1
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses = self.misses + 1
+                return None
+            if count:
+                self.hits = self.hits + 1
+            self.remember(key, entry)
+            return entry
+
+    def put(self, start, dest, mode, departure_hour, entry):
+        key = self.key(start, dest, mode, departure_hour)
+        entry = dict(entry, fetched_at=time.time())
+        with self.lock:
+            self.store[key] = entry
+            self.remember(key, entry)
+        return entry
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'in_memory': len(self.entries),
+        }
+
+    def flush(self):
+        with self.lock:
+            self.store.flush()
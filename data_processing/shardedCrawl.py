@@ -0,0 +1,130 @@
+import importlib
+import json
+import os
+from os.path import abspath, basename, dirname, isfile, join, splitext
+import subprocess
+import sys
+import time
+
+
+def import_project_module(name):
+    # modules of the scrapy project package one level up, e.g. 'pipelines'
+    package_dir = dirname(dirname(abspath(__file__)))
+    if dirname(package_dir) not in sys.path:
+        sys.path.insert(0, dirname(package_dir))
+    return importlib.import_module(basename(package_dir) + '.' + name)
+
+
+def shard_path(path, i):
+    # responses.gz -> responses.0.gz
+    root, ext = splitext(path)
+    return '{}.{}{}'.format(root, i, ext)
+
+
+def split_queries(queries, shards):
+    # round robin, so neighbouring (similarly sized) areas land on
+    # different shards. Repeated areas are crawled once.
+    unique = []
+    for query in queries:
+        if query not in unique:
+            unique.append(query)
+    return [part for part in (unique[i::shards] for i in range(shards)) if part]
+
+
+def merge_shards(shard_paths, output_path, listings_path=None):
+    # merges the shard feeds into one feed, deduplicating on (url, unit).
+    # A removed marker drops the unit, otherwise the last item wins. The
+    # merged items and markers are written into the listing store as well.
+    listings = {}
+    removed = {}
+    for path in shard_paths:
+        if not isfile(path):
+            continue
+        with open(path) as shard_file:
+            for item in json.load(shard_file):
+                key = (item['url'], item['unit'])
+                if item.get('removed'):
+                    listings.pop(key, None)
+                    removed[key] = item
+                else:
+                    listings[key] = item
+                    removed.pop(key, None)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as output_file:
+        json.dump(list(listings.values()) + list(removed.values()), output_file)
+    os.replace(tmp_path, output_path)
+    if listings_path:
+        store = import_project_module('pipelines').ListingStore(listings_path)
+        try:
+            store.write(list(listings.values()) + list(removed.values()))
+        finally:
+            store.close()
+    return len(listings), len(removed)
+
+
+def merge_profiles(profile_paths, profile_path):
+    # adds up the crawl stats of the shards, keeping the largest max_ values
+    merged = {}
+    for path in profile_paths:
+        if not isfile(path):
+            continue
+        with open(path) as profile_file:
+            for (k, v) in json.load(profile_file).items():
+                if not isinstance(v, (int, float)):
+                    continue
+                if 'max_' in k or k == 'elapsed_time_seconds':
+                    merged[k] = max(merged.get(k, v), v)
+                else:
+                    merged[k] = merged.get(k, 0) + v
+        os.remove(path)
+    with open(profile_path, 'w') as profile_file:
+        json.dump(merged, profile_file, indent=2)
+
+
+def run_sharded_crawl(input_path, output_path, shards, crawl_command_dir,
+        spider_args=None, crawl_settings=None, listings_path=None):
+    # Splits the query areas of input_path across `shards` scrapy
+    # processes, each writing its own feed next to output_path, then merges
+    # the feeds into output_path and the listing store. Paths must be
+    # absolute, the crawls run in crawl_command_dir. A PARSE_PROFILE crawl
+    # setting gets one file per shard, added up when they are done, a
+    # RESPONSE_ARCHIVE one archive per shard.
+    with open(input_path) as input_file:
+        data = json.load(input_file)
+    parts = split_queries(data['queries'], shards)
+    shard_dir = output_path + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    crawl_settings = dict(crawl_settings or {})
+    profile_path = crawl_settings.pop('PARSE_PROFILE', None)
+    archive_path = crawl_settings.pop('RESPONSE_ARCHIVE', None)
+    processes = []
+    shard_paths = []
+    started = time.perf_counter()
+    for i, queries in enumerate(parts):
+        shard_input = join(shard_dir, 'input.{}.json'.format(i))
+        shard_output = join(shard_dir, 'output.{}.json'.format(i))
+        with open(shard_input, 'w') as shard_file:
+            json.dump(dict(data, queries=queries), shard_file)
+        if isfile(shard_output):
+            os.remove(shard_output)
+        command = ['scrapy', 'crawl', 'apartments', '-o', shard_output, '-a', 'input=' + shard_input]
+        for (k, v) in (spider_args or {}).items():
+            command += ['-a', '{}={}'.format(k, v)]
+        for (k, v) in crawl_settings.items():
+            command += ['-s', '{}={}'.format(k, v)]
+        if profile_path:
+            command += ['-s', 'PARSE_PROFILE={}.{}'.format(profile_path, i)]
+        if archive_path:
+            command += ['-s', 'RESPONSE_ARCHIVE={}'.format(shard_path(archive_path, i))]
+        print('shard {}: {} areas'.format(i, len(queries)))
+        processes.append(subprocess.Popen(command, cwd=crawl_command_dir))
+        shard_paths.append(shard_output)
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print('shards {} failed, merging what they wrote'.format(failed))
+    listings, removed = merge_shards(shard_paths, output_path, listings_path)
+    if profile_path:
+        merge_profiles(['{}.{}'.format(profile_path, i) for i in range(len(parts))], profile_path)
+    print('crawled {} listings ({} removed) with {} shards in {:.1f}s'.format(
+        listings, removed, len(parts), time.perf_counter() - started))
+    return listings, removed
@@ -0,0 +1,121 @@
+import heapq
+import math
+import numpy as np
+
+earth_radius_miles = 3958.8
+
+
+def to_unit_vector(lat, lng):
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def chord_to_miles(chord):
+    return 2 * earth_radius_miles * math.asin(min(1.0, chord / 2))
+
+
+def haversine_miles(start, dest):
+    lat1, lng1, lat2, lng2 = map(math.radians, (start[0], start[1], dest[0], dest[1]))
+    a = math.sin((lat2 - lat1) / 2)**2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2)**2
+    return 2 * earth_radius_miles * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_miles_many(lats, lngs, dest):
+    # great circle miles from every (lats[i], lngs[i]) to dest, nan where a
+    # row has no coordinates
+    lat1 = np.radians(np.asarray(lats, dtype=float))
+    lng1 = np.radians(np.asarray(lngs, dtype=float))
+    lat2, lng2 = math.radians(dest[0]), math.radians(dest[1])
+    a = np.sin((lat2 - lat1) / 2)**2 + \
+        np.cos(lat1) * math.cos(lat2) * np.sin((lng2 - lng1) / 2)**2
+    return 2 * earth_radius_miles * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def is_geocode(geocode):
+    return isinstance(geocode, (list, tuple)) and len(geocode) == 2 \
+        and all(isinstance(x, (int, float)) for x in geocode)
+
+
+class StationIndex:
+    # kd-tree over the stations placed on the unit sphere. The straight line
+    # (chord) distance between two points on the sphere grows with their
+    # great circle distance, so the nearest stations in 3d are exactly the
+    # haversine nearest stations.
+    def __init__(self, geocodes):
+        self.points = [to_unit_vector(*geocode) if is_geocode(geocode) else None
+            for geocode in geocodes]
+        self.indexed = [index for index, point in enumerate(self.points) if point]
+        self.root = self.build(list(self.indexed), 0)
+        self.batch_tree = None
+
+    def build(self, indices, depth):
+        if not indices:
+            return None
+        axis = depth % 3
+        indices.sort(key=lambda index: self.points[index][axis])
+        median = len(indices) // 2
+        return (indices[median], axis,
+            self.build(indices[:median], depth + 1),
+            self.build(indices[median + 1:], depth + 1))
+
+    def search(self, node, target, k, heap):
+        # heap keeps the k best as (-squared chord, index)
+        if node is None:
+            return
+        index, axis, left, right = node
+        point = self.points[index]
+        squared = (point[0] - target[0])**2 + (point[1] - target[1])**2 + \
+            (point[2] - target[2])**2
+        if len(heap) < k:
+            heapq.heappush(heap, (-squared, index))
+        elif squared < -heap[0][0]:
+            heapq.heapreplace(heap, (-squared, index))
+        diff = target[axis] - point[axis]
+        near, far = (left, right) if diff < 0 else (right, left)
+        self.search(near, target, k, heap)
+        if len(heap) < k or diff * diff < -heap[0][0]:
+            self.search(far, target, k, heap)
+
+    def nearest(self, geocode, k=3):
+        # returns [(miles, station index)] for the k nearest stations
+        heap = []
+        self.search(self.root, to_unit_vector(*geocode), k, heap)
+        return sorted((chord_to_miles(math.sqrt(-squared)), index) for squared, index in heap)
+
+    def nearest_many(self, lats, lngs, k=3):
+        # batch query for whole columns of coordinates, returns (n, k) arrays
+        # of miles and station indices padded with inf / -1 where a row has
+        # no coordinates or there are fewer than k stations
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        miles = np.full((len(lats), k), np.inf)
+        indices = np.full((len(lats), k), -1, dtype=int)
+        valid = np.flatnonzero(~(np.isnan(lats) | np.isnan(lngs)))
+        if len(valid) == 0 or not self.indexed:
+            return miles, indices
+        if self.batch_tree is None:
+            try:
+                from scipy.spatial import cKDTree
+                self.batch_tree = cKDTree(np.array([self.points[index] for index in self.indexed]))
+            except ImportError:
+                self.batch_tree = False
+        if not self.batch_tree:
+            for row in valid:
+                for column, (distance, index) in enumerate(
+                        self.nearest((lats[row], lngs[row]), k)):
+                    miles[row, column] = distance
+                    indices[row, column] = index
+            return miles, indices
+        lat = np.radians(lats[valid])
+        lng = np.radians(lngs[valid])
+        targets = np.column_stack(
+            (np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+        found = min(k, len(self.indexed))
+        chords, nearest = self.batch_tree.query(targets, k=found)
+        chords = chords.reshape(len(valid), found)
+        nearest = nearest.reshape(len(valid), found)
+        miles[valid, :found] = 2 * earth_radius_miles * np.arcsin(np.minimum(1.0, chords / 2))
+        indices[valid, :found] = np.array(self.indexed)[nearest]
+        return miles, indices
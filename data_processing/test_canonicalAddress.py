@@ -0,0 +1,69 @@
+import os
+from os.path import dirname
+import sys
+import unittest
+
+sys.path.insert(0, dirname(os.path.abspath(__file__)))
+
+from canonicalAddress import canonical_address, location_key
+from routeCache import RouteCache, normalize_address
+
+
+class CanonicalAddressTest(unittest.TestCase):
+    def test_spellings_share_a_key(self):
+        self.assertEqual(canonical_address('123 Main Street, Apt #4B, Palo Alto, CA 94301-1234'),
+            '123 main st palo alto ca 94301')
+        self.assertEqual(canonical_address('123  MAIN ST palo alto ca 94301'),
+            '123 main st palo alto ca 94301')
+
+    def test_florida_and_zip_are_kept(self):
+        self.assertEqual(canonical_address('200 Biscayne Blvd, Miami, FL 33101'),
+            '200 biscayne blvd miami fl 33101')
+        self.assertEqual(canonical_address('200 Biscayne Blvd Unit 5, Miami, FL 33101'),
+            '200 biscayne blvd miami fl 33101')
+
+    def test_designator_in_the_street_name_is_kept(self):
+        self.assertEqual(canonical_address('45 Building 5 Rd, Sunnyvale, CA 94086'),
+            '45 building 5 rd sunnyvale ca 94086')
+        self.assertEqual(canonical_address('45 Building 5 Rd Suite 200, Sunnyvale, CA 94086'),
+            '45 building 5 rd sunnyvale ca 94086')
+
+
+class RouteCacheKeyTest(unittest.TestCase):
+    start = '123 Main Street, Palo Alto, CA 94301'
+    dest = '1 Hacker Way, Menlo Park, CA 94025'
+
+    def setUp(self):
+        self.geocodes = {}
+        self.store = {}
+        self.cache = RouteCache(self.store, locate=lambda address: location_key(
+            self.geocodes[address]) if address in self.geocodes else None)
+
+    def test_entry_written_before_one_endpoint_had_a_geocode(self):
+        # the start was geocoded when the route was written, dest later
+        self.geocodes[self.start] = (37.44, -122.16)
+        self.cache.put(self.start, self.dest, 'driving', 9, {'duration': 10.0})
+        self.geocodes[self.dest] = (37.48, -122.15)
+        new_key = self.cache.key(self.start, self.dest, 'driving', 9)
+        self.assertNotIn(new_key, self.store)
+        self.assertEqual(self.cache.get(self.start, self.dest, 'driving', 9)['duration'], 10.0)
+        # moved over to the key on both coordinates
+        self.assertIn(new_key, self.store)
+
+    def test_entries_of_earlier_versions_are_moved(self):
+        self.geocodes[self.start] = (37.44, -122.16)
+        self.geocodes[self.dest] = (37.48, -122.15)
+        old_keys = [
+            '["{}", "{}", "walking", 9]'.format(normalize_address(self.start), normalize_address(self.dest)),
+            self.start + self.dest + 'walking' + '9',
+        ]
+        for old_key in old_keys:
+            self.store.clear()
+            self.store[old_key] = {'duration': 20.0}
+            self.assertEqual(self.cache.get(self.start, self.dest, 'walking', 9)['duration'], 20.0)
+            self.assertIn(self.cache.key(self.start, self.dest, 'walking', 9), self.store)
+            self.cache.entries.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import os
+from os.path import dirname, join
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+# the data_processing modules import each other and a config module that is
+# not part of the repo, the tests point one at a temporary directory
+sys.path.insert(0, dirname(os.path.abspath(__file__)))
+data_dir = tempfile.mkdtemp()
+config = types.ModuleType('config')
+config.google_api_key = 'AIza' + 'x' * 35
+config.loc = '1 Hacker Way, Menlo Park, CA 94025'
+config.data_path = join(data_dir, 'stations.json')
+config.map_cache_data_path = join(data_dir, 'map_cache.json')
+config.station_cache_data_path = join(data_dir, 'station_cache.json')
+config.geocode_cache_data_path = join(data_dir, 'geocode_cache.json')
+config.path_to_data = data_dir
+config.crawl_data_file = 'output.json'
+config.pre_processed_file = 'pre_processed.json'
+config.crawl_command_dir = data_dir
+config.crawl_data_input_file = 'input.json'
+config.lookup_qps = 10000
+sys.modules['config'] = config
+
+from benchmark import FakeClient
+from dataStore import remove_frame
+from distanceCalculator import DistanceCalculator
+import pandas as pd
+from profiler import profiler
+import rank_apts
+
+stations = ['Station {} ({:.3f}, {:.3f})'.format(i, 37.40 + i * 0.01, -122.10 - i * 0.01)
+    for i in range(8)]
+
+
+def tearDownModule():
+    shutil.rmtree(data_dir)
+
+
+def fake_properties(num_properties=30):
+    return pd.DataFrame({
+        'url': ['https://www.apartments.com/apartments-{}/'.format(i) for i in range(num_properties)],
+        'address': ['{} Main St Palo Alto CA 94301'.format(100 + i) for i in range(num_properties)],
+        'feature_list': [['Dishwasher'] for i in range(num_properties)],
+    })
+
+
+class PreprocessTest(unittest.TestCase):
+    # preprocess_data against a stub client and routing caches in a fresh
+    # directory, the second run only reads the caches of the first
+    def setUp(self):
+        for name in os.listdir(data_dir):
+            os.remove(join(data_dir, name))
+        with open(config.data_path, 'w') as stations_file:
+            json.dump({'locations': stations}, stations_file)
+
+    def preprocess(self, batch):
+        client = FakeClient(latency=0)
+        distance_calc = DistanceCalculator(client)
+        try:
+            data = rank_apts.preprocess_data(fake_properties(), batch=batch, distance_calc=distance_calc)
+        finally:
+            distance_calc.pool.close()
+        # the next run starts from the routing caches alone
+        remove_frame(rank_apts.pre_processed_full_path)
+        return data, client.api_calls
+
+    def test_second_run_makes_no_calls(self):
+        first, calls = self.preprocess(batch=True)
+        self.assertGreater(calls['distance_matrix'], 0)
+        self.assertEqual(calls['directions'], 0)
+        self.assertTrue(first[rank_apts.extra_columns].notna().all().all())
+        second, calls = self.preprocess(batch=True)
+        self.assertEqual(calls, {'geocode': 0, 'directions': 0, 'distance_matrix': 0, 'elements': 0})
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_profile_counts_one_lookup_per_request(self):
+        # the reads of what a prefetch just fetched are not cache hits
+        profiler.reset()
+        self.preprocess(batch=True)
+        caches = profiler.report()['caches']
+        for cache in ('geocode', 'station', 'routes'):
+            self.assertEqual(caches[cache]['hits'], 0, cache)
+            self.assertGreater(caches[cache]['misses'], 0, cache)
+        profiler.reset()
+        self.preprocess(batch=True)
+        caches = profiler.report()['caches']
+        for cache in ('geocode', 'station', 'routes'):
+            self.assertEqual(caches[cache]['hit_ratio'], 1.0, cache)
+
+    def test_matrix_matches_directions(self):
+        batched, calls = self.preprocess(batch=True)
+        # at most 25 origins, 25 destinations and 100 elements per request
+        self.assertLessEqual(calls['elements'], 100 * calls['distance_matrix'])
+        self.setUp()
+        unbatched, calls = self.preprocess(batch=False)
+        self.assertGreater(calls['directions'], 0)
+        self.assertEqual(calls['distance_matrix'], 0)
+        pd.testing.assert_frame_equal(batched, unbatched)
+        _, calls = self.preprocess(batch=False)
+        self.assertEqual(calls['directions'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from os.path import dirname, join
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, dirname(os.path.abspath(__file__)))
+
+from benchmark import fake_property_page, import_spider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from shardedCrawl import import_project_module
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # property pages of a local stand-in of the site with an ETag,
+    # answering a matching If-None-Match with 304 unless conditional is off
+    pages = {}
+    conditional = True
+
+    def do_GET(self):
+        body = self.pages.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.conditional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def fetch(request):
+    # the scrapy request over urllib, with its conditional headers
+    headers = dict((k.decode(), v[0].decode()) for k, v in request.headers.items())
+    try:
+        with urlopen(Request(request.url, headers=headers)) as response:
+            return HtmlResponse(request.url, status=response.status,
+                headers=dict(response.headers), body=response.read(), request=request)
+    except HTTPError as error:
+        if error.code != 304:
+            raise
+        return HtmlResponse(request.url, status=304, headers=dict(error.headers), body=b'',
+            request=request)
+
+
+class IncrementalCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        StandInHandler.pages = dict(('/apt-{}/'.format(i), fake_property_page(i, 5))
+            for i in range(2))
+        StandInHandler.conditional = True
+        self.fingerprints_path = join(self.dir, 'fingerprints.sqlite')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def crawl(self, pages):
+        # one incremental crawl of the property pages, returns its items
+        apartments = import_spider()
+        crawler = get_crawler(apartments.ApartmentsSpider)
+        spider = apartments.ApartmentsSpider.from_crawler(crawler,
+            base_url=self.base_url, incremental=self.fingerprints_path)
+        items = []
+        try:
+            for page in pages:
+                response = fetch(spider.apartment_request(self.base_url + 'apt-{}/'.format(page)))
+                items.extend(spider.parse_changed_units(response))
+        finally:
+            spider.closed('finished')
+        return items, crawler.stats
+
+    def test_unchanged_pages_emit_nothing(self):
+        items, _ = self.crawl([0, 1])
+        self.assertEqual(len(items), 10)
+        items, stats = self.crawl([0, 1])
+        self.assertEqual(items, [])
+        self.assertEqual(stats.get_value('incremental/unchanged_pages'), 2)
+        # without a 304 the page hash tells that nothing changed
+        StandInHandler.conditional = False
+        items, stats = self.crawl([0, 1])
+        self.assertEqual(items, [])
+        self.assertEqual(stats.get_value('incremental/unchanged_pages'), 2)
+
+    def test_changed_page_emits_changed_and_removed_units(self):
+        self.crawl([0, 1])
+        # unit 101 gets a new rent and unit 104 is gone
+        StandInHandler.pages['/apt-0/'] = fake_property_page(0, 4).replace(
+            '$1,525 - 1,625', '$1,550 - 1,650')
+        items, stats = self.crawl([0, 1])
+        self.assertEqual([(item['unit'], item['min_rent']) for item in items if not item.get('removed')],
+            [('101', 1550)])
+        self.assertEqual([item for item in items if item.get('removed')],
+            [{'url': self.base_url + 'apt-0/', 'unit': '104', 'removed': True}])
+        self.assertEqual(stats.get_value('incremental/unchanged_pages'), 1)
+
+    def test_forget_unseen(self):
+        self.crawl([0, 1])
+        time.sleep(0.01)
+        started = time.time()
+        self.crawl([0])
+        store = import_project_module('fingerprints').FingerprintStore(self.fingerprints_path)
+        try:
+            self.assertEqual(store.seen_since(started), 1)
+            self.assertEqual(store.forget_unseen(started), {self.base_url + 'apt-0/'})
+            self.assertIsNone(store.get(self.base_url + 'apt-1/'))
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
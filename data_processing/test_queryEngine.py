@@ -0,0 +1,74 @@
+import os
+from os.path import dirname, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(os.path.abspath(__file__)))
+
+from amenityIndex import AmenityIndex, feature_signature
+import pandas as pd
+from queryEngine import add_feature_flags, build_mask
+
+
+class FeatureFlagTest(unittest.TestCase):
+    def flags(self, feature_lists):
+        return add_feature_flags(pd.DataFrame({'feature_list': feature_lists}))
+
+    def test_dishwasher_is_not_a_washer(self):
+        data = self.flags([
+            ['Fireplace', 'Walk-In Closets', 'Dishwasher', 'Air Conditioning', 'Patio'],
+            ['Washer/Dryer', 'Dishwasher'],
+            ['In Unit Washer', 'Central Air'],
+        ])
+        self.assertEqual(list(data['has_washer_dryer']), [False, True, True])
+        mask = build_mask(data, [('has_washer_dryer', 'is', True)])
+        self.assertEqual(list(mask), [False, True, True])
+
+    def test_air_conditioning_within_one_feature(self):
+        data = self.flags([
+            ['Air Conditioning'],
+            ['Fresh Air', 'Carpet'],
+            [],
+            None,
+        ])
+        self.assertEqual(list(data['has_ac']), [True, False, False, False])
+
+
+class AmenityIndexTest(unittest.TestCase):
+    feature_lists = [
+        ['Washer/Dryer', 'Air Conditioning'],
+        ['Dishwasher', 'Fresh Air', 'Carpet'],
+        None,
+        ['In Unit Washer', 'Central Air Conditioning'],
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_saved_index_answers_like_a_built_one(self):
+        built = AmenityIndex(self.feature_lists)
+        built.query('"air c"')
+        path = join(self.dir, 'amenity_index.npz')
+        built.save(path)
+        loaded = AmenityIndex.load(path, self.feature_lists)
+        self.assertEqual(loaded.signature, feature_signature(self.feature_lists))
+        self.assertEqual(list(loaded.phrase_bitsets), [('air', 'c')])
+        for query in ['washer', '"air c"', '"fresh air"', 'dish OR NOT carpet', 'NOT (washer AND air)']:
+            self.assertEqual(list(loaded.query(query)), list(built.query(query)))
+        data = add_feature_flags(pd.DataFrame({'feature_list': self.feature_lists}), loaded)
+        self.assertEqual(list(data['has_washer_dryer']), [True, False, False, True])
+        self.assertEqual(list(data['has_ac']), [True, False, False, True])
+
+    def test_signature_follows_the_features(self):
+        changed = [list(features) if features else features for features in self.feature_lists]
+        changed[1][0] = 'Washer'
+        self.assertNotEqual(feature_signature(changed), feature_signature(self.feature_lists))
+
+
+if __name__ == '__main__':
+    unittest.main()
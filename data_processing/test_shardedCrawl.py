@@ -0,0 +1,71 @@
+import json
+import os
+from os.path import dirname, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(os.path.abspath(__file__)))
+
+from dataStore import load_listings
+from shardedCrawl import import_project_module, merge_shards, split_queries
+
+
+def unit(url, number, rent=1500):
+    return {'url': url, 'unit': str(number), 'name': 'Apartments', 'address': '1 Main St',
+        'phone': None, 'feature_list': [], 'min_rent': rent, 'max_rent': rent}
+
+
+class SplitQueriesTest(unittest.TestCase):
+    def test_round_robin_without_repeats(self):
+        queries = [{'area': 'a/'}, {'area': 'b/'}, {'area': 'a/'}, {'area': 'c/'}, {'area': 'd/'}]
+        self.assertEqual(split_queries(queries, 2),
+            [[{'area': 'a/'}, {'area': 'c/'}], [{'area': 'b/'}, {'area': 'd/'}]])
+
+    def test_no_empty_shards(self):
+        self.assertEqual(split_queries([{'area': 'a/'}, {'area': 'b/'}], 4),
+            [[{'area': 'a/'}], [{'area': 'b/'}]])
+
+
+class MergeShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_shards(self, shards):
+        paths = []
+        for i, items in enumerate(shards):
+            paths.append(join(self.dir, 'output.{}.json'.format(i)))
+            with open(paths[-1], 'w') as shard_file:
+                json.dump(items, shard_file)
+        # a shard that crawled nothing leaves no feed
+        return paths + [join(self.dir, 'output.{}.json'.format(len(shards)))]
+
+    def test_merge(self):
+        a, b = 'http://127.0.0.1/apt-0/', 'http://127.0.0.1/apt-1/'
+        listings_path = join(self.dir, 'listings.sqlite')
+        # the listing store has a unit from an earlier crawl that is now gone
+        store = import_project_module('pipelines').ListingStore(listings_path)
+        store.write([unit(a, 2)])
+        store.close()
+        paths = self.write_shards([
+            [unit(a, 1, 1500), unit(a, 2)],
+            [unit(a, 1, 1600), {'url': a, 'unit': '2', 'removed': True}, unit(b, 1)],
+        ])
+        output_path = join(self.dir, 'output.json')
+        self.assertEqual(merge_shards(paths, output_path, listings_path), (2, 1))
+        with open(output_path) as output_file:
+            merged = json.load(output_file)
+        # (url, unit) is deduplicated, the last item wins
+        self.assertEqual(sorted((item['url'], item['unit'], item.get('min_rent'), bool(item.get('removed')))
+            for item in merged), [(a, '1', 1600, False), (a, '2', None, True), (b, '1', 1500, False)])
+        stored = load_listings(listings_path).frame()
+        self.assertEqual(sorted(zip(stored['url'], stored['unit'], stored['min_rent'])),
+            [(a, '1', 1600), (b, '1', 1500)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Per url fingerprints of the property pages seen by earlier crawls, used by
+# ApartmentsSpider to revalidate pages and to emit only changed units
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def item_hash(item):
+    return hashlib.sha1(json.dumps(item, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, '
+            'last_modified TEXT, content_hash TEXT, next_page TEXT, units TEXT NOT NULL, '
+            'seen_at REAL)')
+        # stores written before the pages had a seen_at
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(pages)')]
+        if 'seen_at' not in columns:
+            self.connection.execute('ALTER TABLE pages ADD COLUMN seen_at REAL')
+
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, content_hash, next_page, units FROM pages WHERE url = ?',
+                (url,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'content_hash': row[2],
+            'next_page': row[3],
+            'units': json.loads(row[4]),
+        }
+
+    def put(self, url, etag, last_modified, content_hash, next_page, units):
+        # units maps every unit of the page to the hash of its item
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages (url, etag, last_modified, content_hash, '
+                'next_page, units, seen_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, content_hash, next_page, json.dumps(units), time.time()))
+
+    def touch(self, url):
+        # the page was reached and did not change
+        with self.lock:
+            self.connection.execute('UPDATE pages SET seen_at = ? WHERE url = ?', (time.time(), url))
+
+    def seen_since(self, timestamp):
+        # the number of pages reached since timestamp
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM pages WHERE seen_at >= ?', (timestamp,)).fetchone()[0]
+
+    def forget_unseen(self, timestamp):
+        # deletes the pages not reached since timestamp, returns the urls
+        # of the pages that are left
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM pages WHERE seen_at IS NULL OR seen_at < ?', (timestamp,))
+            return set(row[0] for row in self.connection.execute('SELECT url FROM pages'))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -5,19 +5,41 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import json
+import time
+
 from scrapy import signals
 
+from .archive import ResponseArchive
+
+# upper bounds (seconds) of the parse time histogram buckets
+parse_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1]
+
 
 class FindapartmentSpiderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
     # passed objects.
+    #
+    # Times every callback (the time spent producing its results, not the
+    # time the pipelines spend on them) into the parse/ crawl stats, and
+    # with PARSE_PROFILE set writes them to that json file when the spider
+    # closes. With RESPONSE_ARCHIVE set every 200 response is appended to
+    # that archive before it reaches the spider, for offline replays.
+
+    def __init__(self, stats=None, profile_path=None, archive_path=None):
+        self.stats = stats
+        self.profile_path = profile_path
+        self.archive_path = archive_path
+        self.archive = None
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler.stats, crawler.settings.get('PARSE_PROFILE'),
+            crawler.settings.get('RESPONSE_ARCHIVE'))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
     def process_spider_input(self, response, spider):
@@ -25,6 +47,13 @@ class FindapartmentSpiderMiddleware(object):
         # middleware and into the spider.
 
         # Should return None or raise an exception.
+        if self.archive and response.status == 200:
+            callback = getattr(response.request.callback, '__name__', 'parse') \
+                if response.request is not None else 'parse'
+            self.archive.write(response.url, response.status,
+                dict(response.headers.to_unicode_dict()), response.body, callback)
+            if self.stats is not None:
+                self.stats.inc_value('archive/responses')
         return None
 
     def process_spider_output(self, response, result, spider):
@@ -32,8 +61,32 @@ class FindapartmentSpiderMiddleware(object):
         # it has processed the response.
 
         # Must return an iterable of Request, dict or Item objects.
-        for i in result:
+        elapsed = 0.0
+        results = iter(result)
+        while True:
+            started = time.perf_counter()
+            try:
+                i = next(results)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                break
+            elapsed += time.perf_counter() - started
             yield i
+        self.record_parse(response, elapsed)
+
+    def record_parse(self, response, elapsed):
+        if self.stats is None:
+            return
+        callback = getattr(response.request.callback, '__name__', 'parse') \
+            if response.request is not None else 'parse'
+        self.stats.inc_value('parse/pages')
+        self.stats.inc_value('parse/seconds', elapsed)
+        self.stats.max_value('parse/max_seconds', elapsed)
+        self.stats.inc_value('parse/{}/pages'.format(callback))
+        self.stats.inc_value('parse/{}/seconds'.format(callback), elapsed)
+        bucket = next((b for b in parse_buckets if elapsed <= b), None)
+        self.stats.inc_value('parse/histogram/{}'.format(
+            '<={}'.format(bucket) if bucket is not None else '>{}'.format(parse_buckets[-1])))
 
     def process_spider_exception(self, response, exception, spider):
         # Called when a spider or process_spider_input() method
@@ -54,3 +107,16 @@ class FindapartmentSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+        if self.archive_path:
+            self.archive = ResponseArchive(self.archive_path)
+
+    def spider_closed(self, spider):
+        if self.archive:
+            self.archive.close()
+        if not self.profile_path or self.stats is None:
+            return
+        stats = self.stats.get_stats()
+        with open(self.profile_path, 'w') as profile_file:
+            json.dump(dict((k, v) for (k, v) in stats.items()
+                if k.startswith(('parse/', 'incremental/', 'archive/', 'item_', 'response_received', 'downloader/'))
+                or k in ('elapsed_time_seconds',)), profile_file, indent=2, default=str)
@@ -5,7 +5,121 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+from collections import OrderedDict
+from datetime import date
+import json
+import math
+import sqlite3
+import time
+
+from scrapy.exceptions import DropItem
+from twisted.internet import threads
+
+
+def normalize_item(item):
+    # json can't encode inf and date objects, missing rents and dates become
+    # None and dates become iso strings
+    for field in ('min_rent', 'max_rent'):
+        if isinstance(item.get(field), float) and math.isinf(item[field]):
+            item[field] = None
+    if isinstance(item.get('avail_date'), date):
+        item['avail_date'] = None if item['avail_date'] == date.max \
+            else item['avail_date'].isoformat()
+    return item
+
+
+class ListingStore(object):
+    # listings keyed by (url, unit) in a sqlite file that other processes can
+    # read while the crawl is still writing to it
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS listings (url TEXT NOT NULL, unit TEXT NOT NULL, '
+            'crawled_at REAL NOT NULL, item TEXT NOT NULL, PRIMARY KEY (url, unit))')
+
+    def write(self, items):
+        now = time.time()
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for item in items:
+                key = (item['url'], item['unit'] or '')
+                if item.get('removed'):
+                    self.connection.execute(
+                        'DELETE FROM listings WHERE url = ? AND unit = ?', key)
+                else:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                        key + (now, json.dumps(item)))
+
+    def close(self):
+        self.connection.close()
+
 
 class FindapartmentPipeline(object):
+    # Drops units already seen in this crawl (a property is reachable from
+    # several query areas and next pages), normalizes the item types and,
+    # when LISTINGS_STORE is set, streams the items into that store in
+    # batches of LISTINGS_BATCH_SIZE while the crawl runs. A spider
+    # enrichment argument is an object with put(address, block) and close(),
+    # rank_apts passes one to start routing the addresses before the crawl
+    # has finished. A put that has to wait and close run in the reactor's
+    # thread pool.
+    def __init__(self, store_path=None, batch_size=100, max_seen=100000):
+        self.store_path = store_path
+        self.enrichment = None
+        self.batch_size = batch_size
+        self.max_seen = max_seen
+        self.seen = OrderedDict()
+        self.batch = []
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            crawler.settings.get('LISTINGS_STORE'),
+            crawler.settings.getint('LISTINGS_BATCH_SIZE', 100),
+            crawler.settings.getint('DEDUP_MAX_KEYS', 100000))
+
+    def open_spider(self, spider):
+        if self.store_path:
+            self.store = ListingStore(self.store_path)
+        self.enrichment = getattr(spider, 'enrichment', None)
+
+    def close_spider(self, spider):
+        self.flush()
+        if self.store:
+            self.store.close()
+        if self.enrichment:
+            spider.logger.info('waiting for the enrichment queue to drain...')
+            return threads.deferToThread(self.enrichment.close)
+
+    def flush(self):
+        if self.store and self.batch:
+            self.store.write(self.batch)
+        self.batch = []
+
+    def is_duplicate(self, key):
+        # remembers the max_seen most recent keys
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return True
+        self.seen[key] = True
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
     def process_item(self, item, spider):
+        if self.is_duplicate((item['url'], item['unit'], bool(item.get('removed')))):
+            raise DropItem('duplicate unit {} of {}'.format(item['unit'], item['url']))
+        item = normalize_item(item)
+        self.batch.append(dict(item))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        if self.enrichment and not item.get('removed') and \
+                not self.enrichment.put(item['address'], block=False):
+            # the queue is full, the item waits for room while the reactor
+            # goes on and scrapy's limit on items in flight slows the crawl
+            return threads.deferToThread(self.enrichment.put, item['address'])\
+                .addCallback(lambda _: item)
         return item
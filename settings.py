@@ -46,9 +46,15 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'findApartment.middlewares.FindapartmentSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'findApartment.middlewares.FindapartmentSpiderMiddleware': 543,
+}
+
+# write the parse times and crawl stats to this json file at the end of the crawl
+#PARSE_PROFILE = 'parse_profile.json'
+
+# append every fetched page to this archive for offline replays
+#RESPONSE_ARCHIVE = 'responses.gz'
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
@@ -64,9 +70,15 @@ ROBOTSTXT_OBEY = True
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'findApartment.pipelines.FindapartmentPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'findApartment.pipelines.FindapartmentPipeline': 300,
+}
+
+# Stream the deduplicated items into a sqlite listing store while crawling
+#LISTINGS_STORE = 'findApartment/data/listings.sqlite'
+#LISTINGS_BATCH_SIZE = 100
+# Number of (url, unit) keys remembered to drop duplicate items
+#DEDUP_MAX_KEYS = 100000
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,14 +1,43 @@
 # -*- coding: utf-8 -*-
 from scrapy.spiders import CrawlSpider, Rule, Request
 from scrapy.linkextractors import LinkExtractor
+from lxml import etree
 import re
 import math
 from datetime import date
 import json
+from urllib.parse import urlparse
+from ..fingerprints import FingerprintStore, content_hash, item_hash
 
 months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 'Jul': 7,
     'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 
+# selectors and patterns are compiled once and run on the lxml tree of the
+# response, page level fields are read once per page and every rent table
+# row is walked once
+apt_name_xpath = etree.XPath('//h1[contains(@class, "propertyName")]/text()')
+street_addr_xpath = etree.XPath('//span[@itemprop="streetAddress"]/text()')
+addr_locality_xpath = etree.XPath('//span[@itemprop="addressLocality"]/text()')
+addr_region_xpath = etree.XPath('//span[@itemprop="addressRegion"]/text()')
+postal_code_xpath = etree.XPath('//span[@itemprop="postalCode"]/text()')
+table_entries_xpath = etree.XPath('//div[contains(@class, "active")]/*/*/*/tr')
+feature_list_xpath = etree.XPath('//h3[contains(.//text(), "Features")]/../ul/li/text()')
+phone_xpath = etree.XPath('//span[@class="contactPhone"]/text()')
+next_page_xpath = etree.XPath('//a[@class="next "]/@href')
+text_xpath = etree.XPath('text()')
+short_span_xpath = etree.XPath('span[contains(@class, "short")]')
+
+word_re = re.compile(r'(\w+)')
+min_rent_re = re.compile(r'\$([\d,]+)')
+max_rent_re = re.compile(r'.* - ([\w,]+)')
+bathroom_num_re = re.compile(r'([\d½]+) BA')
+bedroom_num_re = re.compile(r'(\d) BR')
+sqft_re = re.compile(r'([\w,]+) Sq Ft')
+
+# rent table cells by the class they contain, in the order the old per
+# cell selectors used
+cell_classes = ['rent', 'avail', 'bath', 'bed', 'unit', 'sqft']
+
 def formatted_string_to_int(num_string):
     if num_string:
         return int(num_string.replace(",", ""))
@@ -16,15 +45,15 @@ def formatted_string_to_int(num_string):
         return None
 
 def parse_rent(rent_string):
-    min_rent_re = re.search('\$([\d,]+)', rent_string)
-    max_rent_re = re.search('.* - ([\w,]+)', rent_string)
+    min_rent_match = min_rent_re.search(rent_string) if rent_string else None
+    max_rent_match = max_rent_re.search(rent_string) if rent_string else None
     min_rent = math.inf
     max_rent = math.inf
-    if min_rent_re:
-        min_rent = formatted_string_to_int(min_rent_re.group(1))
-    if max_rent_re:
-        max_rent = formatted_string_to_int(max_rent_re.group(1))
-    elif min_rent_re:
+    if min_rent_match:
+        min_rent = formatted_string_to_int(min_rent_match.group(1))
+    if max_rent_match:
+        max_rent = formatted_string_to_int(max_rent_match.group(1))
+    elif min_rent_match:
         max_rent = min_rent
     return min_rent, max_rent
 
@@ -50,12 +79,92 @@ def convert_bath_num_with_default(value_string, default_value=0):
     else:
         return default_value
 
+def first_text(element):
+    texts = text_xpath(element) if element is not None else []
+    return str(texts[0]) if texts else None
+
+def findall_in_texts(pattern, texts):
+    return [match for text in texts for match in pattern.findall(text)]
+
+def short_span_matches(pattern, element):
+    if element is None:
+        return []
+    return findall_in_texts(pattern,
+        [''.join(span.itertext()) for span in short_span_xpath(element)])
+
+def extract_cells(row):
+    cells = {}
+    for cell in row.iterchildren('td'):
+        cell_class = cell.get('class') or ''
+        for name in cell_classes:
+            if name in cell_class and name not in cells:
+                cells[name] = cell
+    return cells
+
+def extract_apartments(root, url):
+    apt_name = " ".join(findall_in_texts(word_re, apt_name_xpath(root)))
+    apt_address = ' '.join(filter(None, [
+        get_first_from_list(street_addr_xpath(root)),
+        get_first_from_list(addr_locality_xpath(root)),
+        get_first_from_list(addr_region_xpath(root)),
+        get_first_from_list(postal_code_xpath(root))]))
+    phone = get_first_from_list(phone_xpath(root))
+    feature_list = [str(feature) for feature in feature_list_xpath(root)]
+
+    for entry in table_entries_xpath(root):
+        cells = extract_cells(entry)
+        min_rent, max_rent = parse_rent(first_text(cells.get('rent')))
+        avail = cells.get('avail')
+        sqft = cells.get('sqft')
+        bathroom_num = get_first_from_list(short_span_matches(bathroom_num_re, cells.get('bath')))
+        bedroom_num = get_first_from_list(short_span_matches(bedroom_num_re, cells.get('bed')))
+        yield {
+            'name': apt_name,
+            'address': apt_address,
+            'bathroom_num': convert_bath_num_with_default(bathroom_num),
+            'bedroom_num': int(bedroom_num) if bedroom_num else 0,
+            'min_rent': min_rent,
+            'max_rent': max_rent,
+            'unit': first_text(cells.get('unit')),
+            'sqrt_foot': formatted_string_to_int(get_first_from_list(
+                findall_in_texts(sqft_re, text_xpath(sqft) if sqft is not None else []))),
+            'avail_date': parse_available_date(
+                findall_in_texts(word_re, text_xpath(avail) if avail is not None else [])),
+            'phone': str(phone) if phone is not None else None,
+            'url': url,
+            'feature_list': feature_list,
+        }
+
+def unit_fingerprint(item):
+    # "Available Now" parses to today's date, which would change the unit every day
+    if item['avail_date'] == date.today():
+        item = dict(item, avail_date='now')
+    return item_hash(item)
+
 class ApartmentsSpider(CrawlSpider):
     name = 'apartments'
     allowed_domains = ['www.apartments.com']
 
+    # -a base_url=http://localhost:8000/ crawls a local stand-in of the site
+    # -a incremental=fingerprints.sqlite revalidates the property pages seen
+    #    by earlier crawls and only emits the units that changed, plus a
+    #    {'url', 'unit', 'removed': True} item for every unit that is gone.
+    #    Every page reached gets a seen_at, rank_apts drops the properties
+    #    that were not reached (they left the search results) after the crawl
+    def __init__(self, *args, **kwargs):
+        super(ApartmentsSpider, self).__init__(*args, **kwargs)
+        self.base_url = getattr(self, 'base_url', "https://www.apartments.com/")
+        self.domain = urlparse(self.base_url).netloc
+        self.allowed_domains = [urlparse(self.base_url).hostname]
+        fingerprints_path = getattr(self, 'incremental', None)
+        self.fingerprints = FingerprintStore(fingerprints_path) if fingerprints_path else None
+
+    def closed(self, reason):
+        if self.fingerprints:
+            self.fingerprints.close()
+
     def start_requests(self):
-        url = "https://www.apartments.com/"
+        url = self.base_url
         input_file_dir = getattr(self, 'input', None)
         with open(input_file_dir) as data_file:
             data = json.load(data_file)
@@ -70,47 +179,62 @@ class ApartmentsSpider(CrawlSpider):
         #apartment_urls = response.xpath(
         #    '//article/section/div/div/a[contains(@href, "www")]/@href').extract()
         #if apartment_urls.empty():
-        apartment_urls = response.xpath('//article[contains(@data-url, "www.apartments.com")]/@data-url').extract()
+        apartment_urls = response.xpath('//article[contains(@data-url, $domain)]/@data-url',
+            domain=self.domain).extract()
         for url in apartment_urls:
-            yield(Request(url, callback=self.parse_apartment))
+            yield(self.apartment_request(url))
+
+    def apartment_request(self, url):
+        if not self.fingerprints:
+            return Request(url, callback=self.parse_apartment)
+        headers = {}
+        fingerprint = self.fingerprints.get(url)
+        if fingerprint and fingerprint['etag']:
+            headers['If-None-Match'] = fingerprint['etag']
+        if fingerprint and fingerprint['last_modified']:
+            headers['If-Modified-Since'] = fingerprint['last_modified']
+        return Request(url, callback=self.parse_apartment, headers=headers,
+            meta={'handle_httpstatus_list': [304]})
 
     def parse_apartment(self, response):
-        apt_name = " ".join(response.xpath('//h1[contains(@class, "propertyName")]/text()').re(r'(\w+)'))
-        street_addr = response.xpath('//span[@itemprop="streetAddress"]/text()').extract_first()
-        addr_locality = response.xpath('//span[@itemprop="addressLocality"]/text()').extract_first()
-        addr_region = response.xpath('//span[@itemprop="addressRegion"]/text()').extract_first()
-        postal_code = response.xpath('//span[@itemprop="postalCode"]/text()').extract_first()
-
-        apt_address = ' '.join(filter(None, [street_addr, addr_locality, addr_region, postal_code]))
-
-        table_entries = response.xpath('//div[contains(@class, "active")]/*/*/*/tr')
-        feature = response.xpath('//h3[contains(.//text(), "Features")]')
-        phone = response.xpath('//span[@class="contactPhone"]/text()').extract_first()
-
-        for entry in table_entries:
-            rent_string = entry.xpath(
-                './td[contains(@class, "rent")]/text()').extract_first()
-            min_rent, max_rent = parse_rent(rent_string)
-            avail_date = entry.xpath('./td[contains(@class, "avail")]/text()').re(r'(\w+)')
-            bathroom_num = get_first_from_list(entry.xpath('./td[contains(@class, "bath")]/span[contains(@class, "short")]').re(r'([\d½]+) BA'))
-            bedroom_num = get_first_from_list(entry.xpath('./td[contains(@class, "bed")]/span[contains(@class,"short")]').re(r'(\d) BR'))
-            yield {
-                'name': apt_name,
-                'address': apt_address,
-                'bathroom_num': convert_bath_num_with_default(bathroom_num),
-                'bedroom_num': int(bedroom_num) if bedroom_num else 0,
-                'min_rent': min_rent,
-                'max_rent': max_rent,
-                'unit': entry.xpath('./td[contains(@class, "unit")]/text()').extract_first(),
-                'sqrt_foot': formatted_string_to_int(get_first_from_list(
-                    entry.xpath('./td[contains(@class, "sqft")]/text()').re(r'([\w,]+) Sq Ft'))),
-                'avail_date': parse_available_date(
-                    entry.xpath('./td[contains(@class, "avail")]/text()').re(r'(\w+)')
-                ),
-                'phone': phone,
-                'url': response.url,
-                'feature_list': feature.xpath('../ul/li/text()').extract(),
-            }
-        next_page = response.xpath('//a[@class="next "]/@href').extract_first()
+        if self.fingerprints:
+            for result in self.parse_changed_units(response):
+                yield result
+            return
+        root = response.selector.root
+        for item in extract_apartments(root, response.url):
+            yield item
+        next_page = get_first_from_list(next_page_xpath(root))
+        if next_page:
+            yield Request(str(next_page), callback=self.parse_apartment)
+
+    def parse_changed_units(self, response):
+        fingerprint = self.fingerprints.get(response.url)
+        body_hash = content_hash(response.body) if response.status != 304 else None
+        if fingerprint and (response.status == 304 or body_hash == fingerprint['content_hash']):
+            self.crawler.stats.inc_value('incremental/unchanged_pages')
+            self.fingerprints.touch(response.url)
+            if fingerprint['next_page']:
+                yield self.apartment_request(fingerprint['next_page'])
+            return
+        self.crawler.stats.inc_value('incremental/changed_pages')
+        old_units = fingerprint['units'] if fingerprint else {}
+        units = {}
+        root = response.selector.root
+        for item in extract_apartments(root, response.url):
+            unit = str(item['unit'])
+            units[unit] = unit_fingerprint(item)
+            if old_units.get(unit) != units[unit]:
+                self.crawler.stats.inc_value('incremental/changed_units')
+                yield item
+        for unit in old_units:
+            if unit not in units:
+                self.crawler.stats.inc_value('incremental/removed_units')
+                yield {'url': response.url, 'unit': None if unit == 'None' else unit, 'removed': True}
+        next_page = get_first_from_list(next_page_xpath(root))
+        self.fingerprints.put(response.url,
+            (response.headers.get('ETag') or b'').decode('latin-1') or None,
+            (response.headers.get('Last-Modified') or b'').decode('latin-1') or None,
+            body_hash, str(next_page) if next_page else None, units)
         if next_page:
-            yield Request(next_page, callback=self.parse_apartment)
+            yield self.apartment_request(str(next_page))